@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Microbenchmarks for the gmail_query parse, group, write and sort stages
+
+Each stage runs on synthetic Gmail API messages (see fixtures.py) at
+each requested size, in its own process, and reports throughput and
+peak memory. Nothing talks to Gmail.
+
+Stages
+------
+
+parse_msg   gmail_query.parse_msg on every message (pandoc is replaced
+            by a passthrough unless --pandoc is given, so the numbers
+            measure this module and not the pandoc binary; --renderer
+            native times the in-process renderer instead)
+mime_walk   index_parts on every payload
+wrap_base64 re-wrapping attachment data as eml output does
+group       messages_df (data frame construction and thread sort)
+write       print_df_query into a temporary folder (with --io-threads
+            writer threads, thread folders in --layout)
+sort        sort_query (apply_rules) over the written thread folders
+
+Usage
+-----
+
+$ python benchmarks/bench_gmail_query.py
+$ python benchmarks/bench_gmail_query.py --sizes 1000 10000 --stages parse_msg
+$ python benchmarks/bench_gmail_query.py --json after.json --compare before.json
+$ python benchmarks/bench_gmail_query.py --stages parse_msg --renderer native
+
+Peak memory is the tracemalloc peak of the stage process on Python 3
+(Python allocations, fixtures included) and the maximum resident set
+size on Python 2. tracemalloc slows allocation-heavy stages several
+times over, so on Python 3 each stage runs twice: timed without it,
+then again for the peak.
+"""
+
+from __future__ import division, print_function
+from multiprocessing import Process, Queue
+from os import path
+import datetime
+import tempfile
+import argparse
+import shutil
+import random
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+import gmail_query as gq
+import fixtures
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+    import resource
+
+timer  = getattr(time, 'perf_counter', time.time)
+stages = ['parse_msg', 'mime_walk', 'wrap_base64', 'group', 'write', 'sort']
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('--sizes', type = int, nargs = '+',
+                        default = [1000, 10000, 100000],
+                        help = "Numbers of messages.")
+    parser.add_argument('--stages', nargs = '+', default = stages,
+                        choices = stages, help = "Stages to run.")
+    parser.add_argument('--otype', default = 'html', help = "Output type.")
+    parser.add_argument('--html-kb', type = int, default = 4,
+                        help = "HTML body size (large bodies are 64x).")
+    parser.add_argument('--att-kb', type = int, default = 64,
+                        help = "Attachment size.")
+    parser.add_argument('--io-threads', type = int, default = 8,
+                        help = "Output writer threads (0 is serial).")
+    parser.add_argument('--layout', default = 'flat', choices = gq.layouts,
+                        help = "Thread folder layout in write and sort.")
+    parser.add_argument('--renderer', default = 'pandoc',
+                        choices = ['pandoc', 'native'],
+                        help = "Body renderer in parse_msg.")
+    parser.add_argument('--raw-body-size', metavar = 'SIZE',
+                        help = "Bodies over SIZE skip conversion in parse_msg.")
+    parser.add_argument('--pandoc', action = 'store_true',
+                        help = "Convert with pandoc in parse_msg.")
+    parser.add_argument('--json', metavar = 'FILE',
+                        help = "Save results to FILE.")
+    parser.add_argument('--compare', metavar = 'FILE',
+                        help = "Compare against results saved with --json.")
+    args = parser.parse_args()
+
+    before = {}
+    if args.compare:
+        for res in json.load(open(args.compare)):
+            before[(res['stage'], res['n'])] = res
+
+    results = []
+    print("%-11s %8s %9s %12s %9s %9s %8s" %
+          ('stage', 'n', 'seconds', 'items/s', 'MiB/s', 'peak MiB', 'change'))
+    for stage in args.stages:
+        for n in args.sizes:
+            res = run_stage(stage, n, args)
+            results += [res]
+
+            change = ''
+            if (stage, n) in before and res['seconds'] > 0:
+                speedup = before[(stage, n)]['seconds'] / res['seconds']
+                change  = '%.2fx' % speedup
+
+            print("%-11s %8d %9.2f %12.1f %9.1f %9.1f %8s" %
+                  (stage, n, res['seconds'], res['items'] / res['seconds'],
+                   res['bytes'] / res['seconds'] / 2 ** 20,
+                   res['peak'] / 2 ** 20, change))
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as fout:
+            json.dump(results, fout, indent = 2)
+
+def run_stage(stage, n, args):
+    """Run stage on n messages in a child process
+
+    The timing run is untraced; with tracemalloc the peak comes from a
+    second, traced run.
+    """
+
+    res = stage_process(stage, n, args, False)
+    if tracemalloc is not None:
+        res['peak'] = stage_process(stage, n, args, True)['peak']
+
+    return res
+
+def stage_process(stage, n, args, trace):
+    queue = Queue()
+    child = Process(target = stage_child, args = (queue, stage, n, args,
+                                                  trace))
+    child.start()
+    res = queue.get()
+    child.join()
+    if 'error' in res:
+        raise RuntimeError("%s at %d failed: %s" % (stage, n, res['error']))
+
+    return res
+
+def stage_child(queue, stage, n, args, trace = False):
+    try:
+        if trace:
+            tracemalloc.start()
+
+        seconds, items, nbytes = globals()['bench_' + stage](n, args)
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+        elif tracemalloc is None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        else:
+            peak = None  # From the traced run
+
+        queue.put({'stage':   stage,
+                   'n':       n,
+                   'seconds': seconds,
+                   'items':   items,
+                   'bytes':   nbytes,
+                   'peak':    peak})
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+# ---------------------------------------------------------------------
+# Stages; each returns (seconds, items processed, bytes processed)
+
+class passthrough_pandoc():
+
+    """Stands in for pypandoc so parse_msg is timed without pandoc"""
+
+    @staticmethod
+    def convert_text(text, to, format = None, extra_args = None):
+        return gq.unicode(text)
+
+def bare_query():
+    """gmail_query object with what parsing needs and no API client"""
+
+    query = gq.gmail_query.__new__(gq.gmail_query)
+    query.timezone = gq.tz.tzlocal()
+    query.tzstr    = datetime.datetime.now(query.timezone).tzname()
+    query.metrics  = gq.run_metrics()
+    query.renderer = 'pandoc'
+    query.layout   = 'flat'
+    query.raw_max  = None
+    return query
+
+def mailbox(n, args):
+    return fixtures.iter_mailbox(n, html_kb = args.html_kb, att_kb = args.att_kb)
+
+def bench_parse_msg(n, args):
+    if not args.pandoc:
+        gq.pandoc = passthrough_pandoc
+
+    query   = bare_query()
+    seconds = 0
+    nbytes  = 0
+    query.renderer = args.renderer
+    if args.raw_body_size:
+        query.raw_max = int(gq.parse_string(args.raw_body_size).bytes)
+    for msg, atts in mailbox(n, args):
+        start    = timer()
+        query.parse_msg(msg, args.otype)
+        seconds += timer() - start
+        nbytes  += msg['sizeEstimate'] - sum(atts.values())
+
+    return seconds, n, nbytes
+
+def bench_mime_walk(n, args):
+    seconds = 0
+    for msg, atts in mailbox(n, args):
+        start    = timer()
+        gq.index_parts(msg['payload'])
+        seconds += timer() - start
+
+    return seconds, n, 0
+
+def bench_wrap_base64(n, args):
+    seconds = 0
+    nbytes  = 0
+    for msg, atts in mailbox(n, args):
+        for att_id, size in atts.items():
+            data     = fixtures.att_data(att_id, size)['data']
+            start    = timer()
+            for chunk in gq.wrap_base64(data):
+                pass
+
+            seconds += timer() - start
+            nbytes  += len(data)
+
+    return seconds, n, nbytes
+
+def parsed_rows(n, args):
+    """parse_msg/parse_att-like rows for n messages
+
+    Bodies and attachment data are shared strings, so memory reflects
+    the data frame and not the fixtures.
+    """
+
+    query  = bare_query()
+    body   = fixtures.html_body(args.html_kb, random.Random(0))
+    att    = fixtures.att_data('shared', args.att_kb * 1024)['data']
+    ids    = []
+    thrs   = []
+    parsed = []
+    atts   = []
+    for msg, msg_atts in fixtures.iter_mailbox(n, html_kb = 0, att_kb = 0):
+        head   = dict((h['name'], h['value']) for h in msg['payload']['headers'])
+        date   = datetime.datetime.utcfromtimestamp(int(msg['internalDate']) / 1000)
+        date   = date.replace(tzinfo = query.timezone)
+        plain  = os.linesep.join(['From: ' + head['From'],
+                                  'To: ' + head['To'],
+                                  'Subject: ' + head['Subject']])
+        ids    += [msg['id']]
+        thrs   += [msg['threadId']]
+        parsed += [[body, plain, plain, date, head['Subject'], head['From'],
+                    head['To'], head['Cc'], 'text/html',
+                    int(msg['internalDate'])]]
+        atts   += [[['file.bin'], [att], [len(att) * 3 // 4]]
+                   if msg_atts else [[], [], []]]
+
+    return query, ids, thrs, parsed, atts
+
+def bench_group(n, args):
+    query, ids, thrs, parsed, atts = parsed_rows(n, args)
+    start = timer()
+    gq.messages_df(ids, thrs, parsed, atts, False)
+    return timer() - start, n, 0
+
+def write_rows(n, args, outdir):
+    query, ids, thrs, parsed, atts = parsed_rows(n, args)
+    df     = gq.messages_df(ids, thrs, parsed, atts, False)
+    ext    = gq.ext_dict.get(args.otype, '.txt')
+    writer = gq.output_writer(args.io_threads)
+    start  = timer()
+    query.layout = args.layout
+    gq.print_df_query(df, outdir, query.tzstr, args.otype, ext,
+                      query.metrics, writer, layout = args.layout)
+    return timer() - start, query
+
+def bench_write(n, args):
+    outdir = tempfile.mkdtemp(prefix = 'bench_gmail_query')
+    try:
+        seconds, query = write_rows(n, args, outdir)
+        return seconds, n, query.metrics.counters.get('bytes_written', 0)
+    finally:
+        shutil.rmtree(outdir)
+
+def bench_sort(n, args):
+    outdir = tempfile.mkdtemp(prefix = 'bench_gmail_query')
+    try:
+        seconds, query = write_rows(n, args, path.join(outdir, 'mail'))
+        rules = path.join(outdir, 'rules.json')
+        with open(rules, 'w') as fout:
+            json.dump({'senders': {'rules': ['from:.*sender1@'],
+                                   'priority': 0},
+                       'reports': {'rules': ['subject:.*Thread \\d*7:'],
+                                   'priority': 1},
+                       'never':   {'rules': ['cookies@(gmail|yahoo)\\.com'],
+                                   'priority': 2}}, fout)
+
+        start = timer()
+        query.sort_query(rules, False, path.join(outdir, 'mail'))
+        return timer() - start, n, 0
+    finally:
+        shutil.rmtree(outdir)
+
+if __name__ == '__main__':
+    main()
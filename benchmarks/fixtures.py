@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+
+"""Synthetic Gmail API message fixtures
+
+Messages look like the `format = 'full'` output of users.messages.get:
+nested multipart trees, large HTML bodies, attachments referenced by
+attachmentId, and long threads. Everything is deterministic given the
+seed, so runs are comparable.
+
+Usage
+-----
+
+>>> from fixtures import make_mailbox
+>>> msgs, atts = make_mailbox(1000)
+"""
+
+from __future__ import division, print_function
+import datetime
+import base64
+import random
+
+kinds = ['simple', 'nested', 'large_html', 'attachment']
+
+def b64(data):
+    """URL-safe base64, as the Gmail API returns body and attachment data"""
+
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+def att_data(att_id, size):
+    """Attachment data for att_id, generated on demand
+
+    Returns:
+        The users.messages.attachments.get response body
+    """
+
+    rng   = random.Random(att_id)
+    block = bytes(bytearray(rng.getrandbits(8) for b in range(256)))
+    data  = block * (size // 256) + block[:size % 256]
+    return {'attachmentId': att_id, 'size': size, 'data': b64(data)}
+
+def html_body(kb, rng):
+    """HTML body of roughly kb KiB with paragraphs, links and a table"""
+
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur',
+             'adipiscing', 'elit', 'sed', 'do', 'eiusmod', 'tempor']
+    paras = []
+    size  = 0
+    while size < kb * 1024:
+        text   = ' '.join(rng.choice(words) for i in range(60))
+        para   = '<p style="margin:0 0 8px 0">%s <a href="https://example.com/%d">'\
+                 'link</a></p>' % (text, size)
+        paras += [para]
+        size  += len(para)
+
+    table = '<table>' + ''.join('<tr><td>%d</td><td>%s</td></tr>' % (i, w)
+                                for i, w in enumerate(words)) + '</table>'
+    return '<html><body><div>%s%s</div></body></html>' % (''.join(paras), table)
+
+def text_part(mime, text, part_id):
+    data = b64(text)
+    return {'partId':   part_id,
+            'mimeType': mime,
+            'filename': '',
+            'headers':  [{'name': 'Content-Type',
+                          'value': mime + '; charset="UTF-8"'}],
+            'body':     {'size': len(text), 'data': data}}
+
+def att_part(fname, size, att_id, part_id):
+    return {'partId':   part_id,
+            'mimeType': 'application/octet-stream',
+            'filename': fname,
+            'headers':  [{'name': 'Content-Disposition',
+                          'value': 'attachment; filename="%s"' % fname}],
+            'body':     {'attachmentId': att_id, 'size': size}}
+
+def multipart(mime, parts, part_id):
+    return {'partId':   part_id,
+            'mimeType': mime,
+            'filename': '',
+            'headers':  [{'name': 'Content-Type', 'value': mime}],
+            'body':     {'size': 0},
+            'parts':    parts}
+
+def make_message(i,
+                 thread,
+                 when,
+                 kind     = 'simple',
+                 html_kb  = 4,
+                 att_kb   = 64,
+                 depth    = 4,
+                 rng      = None):
+    """One message in users.messages.get format = 'full' shape
+
+    Args:
+        i: Message number (the id is derived from it)
+        thread: Thread number
+        when: Message datetime (UTC)
+
+    Kwargs:
+        kind: 'simple' (text/html), 'nested' (depth levels of
+            multipart/mixed and related around multipart/alternative),
+            'large_html' (html_kb * 64 KiB body) or 'attachment'
+            (multipart/mixed with two attachments of att_kb KiB)
+
+    Returns:
+        msg: Message dictionary
+        atts: Dictionary of attachment id -> size (see att_data)
+    """
+
+    rng   = random.Random(i) if rng is None else rng
+    msgid = '%016x' % (0x15000000000 + i)
+    html  = html_body(html_kb * (64 if kind == 'large_html' else 1), rng)
+    plain = 'Plain text version of message %d' % i
+    alt   = multipart('multipart/alternative',
+                      [text_part('text/plain', plain, '0.0'),
+                       text_part('text/html', html, '0.1')],
+                      '0')
+
+    atts = {}
+    if kind == 'simple':
+        payload = text_part('text/html', html, '')
+    elif kind == 'nested':
+        payload = alt
+        for d in range(depth):
+            mime    = 'multipart/related' if d % 2 else 'multipart/mixed'
+            payload = multipart(mime, [payload], '')
+    elif kind == 'attachment':
+        parts = [alt]
+        for a in range(2):
+            att_id  = 'ANGjdJ%s%d' % (msgid, a)
+            size    = att_kb * 1024
+            atts[att_id] = size
+            parts  += [att_part('file%d.bin' % a, size, att_id, str(a + 1))]
+
+        payload = multipart('multipart/mixed', parts, '')
+    else:
+        payload = alt
+
+    date = when.strftime('%a, %d %b %Y %H:%M:%S +0000')
+    payload['headers'] = payload['headers'] + [
+        {'name': 'From',    'value': 'Sender %d <sender%d@example%d.com>' %
+                                     (i % 97, i % 97, i % 7)},
+        {'name': 'To',      'value': 'me@example.com'},
+        {'name': 'Cc',      'value': 'team%d@example.com' % (i % 5)},
+        {'name': 'Subject', 'value': 'Thread %d: quarterly report' % thread},
+        {'name': 'Date',    'value': date}]
+
+    epoch = (when - datetime.datetime(1970, 1, 1)).total_seconds()
+    msg   = {'id':           msgid,
+             'threadId':     '%016x' % (0x15000000000 + thread),
+             'labelIds':     ['INBOX'],
+             'snippet':      plain[:100],
+             'internalDate': str(int(epoch * 1000)),
+             'sizeEstimate': len(html) + len(plain) + sum(atts.values()),
+             'historyId':    str(1000 + i),
+             'payload':      payload}
+
+    return msg, atts
+
+def make_mailbox(n, **kwargs):
+    """n messages spread over days, in short and long threads
+
+    Args:
+        n: Number of messages
+
+    Kwargs:
+        kwargs: Passed to iter_mailbox
+
+    Returns:
+        msgs: List of messages (kinds cycle through `kinds`)
+        atts: Dictionary of attachment id -> size (see att_data)
+    """
+
+    msgs = []
+    atts = {}
+    for msg, att in iter_mailbox(n, **kwargs):
+        msgs += [msg]
+        atts.update(att)
+
+    return msgs, atts
+
+def iter_mailbox(n,
+                 day        = '2016-06-01',
+                 days       = 1,
+                 long_every = 20,
+                 long_len   = 50,
+                 seed       = 0,
+                 **kwargs):
+    """Generate n messages one at a time (see make_mailbox)
+
+    Args:
+        n: Number of messages
+
+    Kwargs:
+        day: First day (YYYY-MM-DD)
+        days: Number of days the messages are spread over
+        long_every: Every long_every-th thread is a long thread
+        long_len: Messages in a long thread (short threads have 1-3)
+        kwargs: Passed to make_message
+
+    Returns:
+        Generator of (msg, atts) pairs, as make_message
+    """
+
+    rng    = random.Random(seed)
+    start  = datetime.datetime.strptime(day, '%Y-%m-%d')
+    step   = datetime.timedelta(seconds = days * 86400 / max(n, 1))
+    thread = 0
+    left   = 0
+    for i in range(n):
+        if left == 0:
+            thread += 1
+            left    = long_len if thread % long_every == 0 else rng.randint(1, 3)
+
+        left -= 1
+        kind  = kinds[i % len(kinds)]
+        yield make_message(i, thread, start + step * i, kind, **kwargs)
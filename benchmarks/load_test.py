@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""End-to-end load test of gmail_query.query against stub_server.py
+
+Starts the local Gmail API stand-in in this process, points a
+gmail_query object at it, runs a full query into a temporary folder
+and reports throughput, request latency quantiles (from gmail_query's
+run metrics) and the server's request counts.
+
+Usage
+-----
+
+$ python benchmarks/load_test.py --messages 5000 --days 7 --latency 50
+$ python benchmarks/load_test.py --rate 100 --error-rate 0.01 --workers 32
+$ python benchmarks/load_test.py --messages 5000 --latency 50 --threads
+"""
+
+from __future__ import division, print_function
+from os import path
+import threading
+import tempfile
+import argparse
+import datetime
+import shutil
+import time
+import sys
+import os
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+
+from stub_server import stub_server
+import gmail_query as gq
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('--messages', type = int, default = 1000)
+    parser.add_argument('--day', default = '2016-06-01')
+    parser.add_argument('--days', type = int, default = 1)
+    parser.add_argument('--latency', type = float, default = 20,
+                        help = "Mean added server latency (ms).")
+    parser.add_argument('--rate', type = float, default = 0,
+                        help = "Server requests per second before 429.")
+    parser.add_argument('--error-rate', type = float, default = 0,
+                        help = "Fraction of requests that fail with 500.")
+    parser.add_argument('--workers', type = int, default = 8)
+    parser.add_argument('--otype', default = 'html')
+    parser.add_argument('--threads', action = 'store_true',
+                        help = "Get whole threads (threads.get).")
+    parser.add_argument('--attachments', action = 'store_true',
+                        help = "Download attachments.")
+    parser.add_argument('--keep', action = 'store_true',
+                        help = "Keep the output folder.")
+    args = parser.parse_args()
+
+    server = stub_server(('localhost', 0),
+                         messages   = args.messages,
+                         day        = args.day,
+                         days       = args.days,
+                         latency    = args.latency,
+                         rate       = args.rate,
+                         error_rate = args.error_rate)
+    thread = threading.Thread(target = server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    tmpdir  = tempfile.mkdtemp(prefix = 'gmail_load_test')
+    cfgfile = path.join(tmpdir, 'gmail_query.conf')
+    with open(cfgfile, 'w') as cfg:
+        cfg.write("[Setup]" + os.linesep)
+        cfg.write("api_root = {}".format(server.root + os.linesep))
+        cfg.write("quota_rate = 1000000" + os.linesep)
+        cfg.write("fetch_threads = {}".format(args.threads) + os.linesep)
+
+    last  = datetime.datetime.strptime(args.day, '%Y-%m-%d')
+    last += datetime.timedelta(days = args.days - 1)
+    try:
+        query = gq.gmail_query(path.join(tmpdir, 'mail'),
+                               cfgfile = cfgfile,
+                               workers = args.workers)
+        start = time.time()
+        query.query(todays  = last.strftime('%Y-%m-%d'),
+                    bdays   = args.days - 1,
+                    otype   = args.otype,
+                    att_get = args.attachments,
+                    mail    = False)
+        wall  = time.time() - start
+
+        report = query.metrics.report()
+        nmsgs  = report['counters'].get('messages', 0)
+        print()
+        print("%d messages in %.1fs (%.1f messages/s) with %d workers" %
+              (nmsgs, wall, nmsgs / wall, args.workers))
+        for name in ['list', 'get_msg', 'get_thread', 'get_att']:
+            if name in report['stages']:
+                print("%-10s p50 %s  p95 %s  p99 %s" %
+                      tuple([name] + [quantile(report, name, q)
+                                      for q in [0.5, 0.95, 0.99]]))
+
+        print("Server requests: %s" % server.stats)
+    finally:
+        server.shutdown()
+        if args.keep:
+            print("Output in " + tmpdir)
+        else:
+            shutil.rmtree(tmpdir)
+
+def quantile(report, stage, q):
+    """Upper bucket bound holding quantile q of stage's latencies"""
+
+    stage = report['stages'][stage]
+    total = stage['calls']
+    for le, n in zip(report['buckets'], stage['buckets']):
+        if n >= q * total:
+            return '<=%gs' % le
+
+    return '>%gs' % report['buckets'][-1]
+
+if __name__ == '__main__':
+    main()
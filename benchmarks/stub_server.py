@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for the subset of the Gmail API gmail_query uses
+
+Serves a synthetic mailbox (see fixtures.py) over HTTP with a discovery
+document, so gmail_query can be pointed at it with `api_root` (or
+`--api-root`) and run offline, without credentials or quota.
+
+Implemented: users.messages.list (q = after:/before: with dates or epoch
+seconds, paging), users.messages.get (format full, metadata with
+metadataHeaders, minimal), users.messages.attachments.get,
+users.messages.insert, users.threads.list, users.threads.get (same
+formats) and users.history.list. Batch requests are not supported
+(gmail_query does not send them); `fields` is ignored.
+
+Latency, throttling and errors can be injected:
+
+--latency MS      Mean added latency per request (exponentially
+                  distributed, so there is a tail)
+--rate N          Requests per second before answering 429
+--error-rate P    Fraction of requests answered with a 500
+
+GET /stats returns request counts by method and status.
+
+Usage
+-----
+
+$ python benchmarks/stub_server.py --messages 5000 --days 7 --latency 40
+$ gmail_query.py -d 2016-06-07 -b 7 --api-root http://localhost:8765/
+"""
+
+from __future__ import division, print_function
+from os import path
+import threading
+import argparse
+import datetime
+import random
+import base64
+import email
+import json
+import time
+import sys
+import re
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+import fixtures
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n')[0])
+    parser.add_argument('--host', default = 'localhost')
+    parser.add_argument('--port', type = int, default = 8765)
+    parser.add_argument('--messages', type = int, default = 1000,
+                        help = "Messages in the mailbox.")
+    parser.add_argument('--day', default = '2016-06-01',
+                        help = "First day with messages.")
+    parser.add_argument('--days', type = int, default = 1,
+                        help = "Days the messages are spread over.")
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = "Mean added latency (ms).")
+    parser.add_argument('--rate', type = float, default = 0,
+                        help = "Requests per second before 429 (0 is no limit).")
+    parser.add_argument('--error-rate', type = float, default = 0,
+                        help = "Fraction of requests that fail with 500.")
+    args = parser.parse_args()
+
+    server = stub_server((args.host, args.port),
+                         messages   = args.messages,
+                         day        = args.day,
+                         days       = args.days,
+                         latency    = args.latency,
+                         rate       = args.rate,
+                         error_rate = args.error_rate)
+
+    print("Serving %d messages at %s" % (args.messages, server.root))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+class stub_server(ThreadingMixIn, HTTPServer):
+
+    """Threaded HTTP server holding the synthetic mailbox"""
+
+    daemon_threads = True
+
+    def __init__(self,
+                 address,
+                 messages   = 1000,
+                 day        = '2016-06-01',
+                 days       = 1,
+                 latency    = 0,
+                 rate       = 0,
+                 error_rate = 0,
+                 **kwargs):
+
+        HTTPServer.__init__(self, address, stub_handler)
+
+        msgs, atts = fixtures.make_mailbox(messages, day = day, days = days,
+                                           **kwargs)
+        self.msgs   = dict((msg['id'], msg) for msg in msgs)
+        self.order  = sorted(self.msgs,
+                             key = lambda mid: -int(self.msgs[mid]['internalDate']))
+        self.atts   = atts
+        self.att_bodies = {}
+        self.threads = {}
+        for mid in reversed(self.order):
+            self.threads.setdefault(self.msgs[mid]['threadId'], []).append(mid)
+        self.root   = 'http://%s:%d/' % self.server_address[:2]
+        self.lock   = threading.Lock()
+        self.stats  = {}
+
+        self.latency    = latency / 1000
+        self.rate       = rate
+        self.error_rate = error_rate
+        self.tokens     = rate
+        self.stamp      = time.time()
+
+    def throttled(self):
+        """Token bucket; True if the request is over --rate"""
+
+        if not self.rate:
+            return False
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp  = now
+            if self.tokens < 1:
+                return True
+
+            self.tokens -= 1
+            return False
+
+    def count(self, method, status):
+        with self.lock:
+            key = '%s %d' % (method, status)
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def insert(self, body):
+        """Add a message from its raw (base64url RFC 822) form
+
+        The payload tree is parsed from the MIME message as Gmail does;
+        parts with a file name are served as attachments.
+        """
+
+        raw = body.get('raw', '')
+        mime = base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+        if hasattr(email, 'message_from_bytes'):
+            mime = email.message_from_bytes(mime)
+        else:
+            mime = email.message_from_string(mime)
+
+        with self.lock:
+            msgid = '%016x' % (0x16000000000 + len(self.msgs))
+            now   = int(time.time() * 1000)
+            msg   = {'id':           msgid,
+                     'threadId':     msgid,
+                     'labelIds':     ['INBOX'],
+                     'internalDate': str(now),
+                     'historyId':    str(1000 + len(self.msgs)),
+                     'sizeEstimate': len(raw) * 3 // 4,
+                     'payload':      mime_payload(mime, msgid,
+                                                  self.att_bodies)}
+            self.msgs[msgid] = msg
+            self.order.insert(0, msgid)
+            self.threads[msgid] = [msgid]
+
+        return {'id': msgid, 'threadId': msgid, 'labelIds': ['INBOX']}
+
+class stub_handler(BaseHTTPRequestHandler):
+
+    """Routes Gmail API paths to the mailbox"""
+
+    routes = [('GET',  r'^/discovery/v1/apis/gmail/v1/rest$', 'discovery'),
+              ('GET',  r'^/stats$', 'stats'),
+              ('GET',  r'^/gmail/v1/users/[^/]+/messages$', 'list'),
+              ('POST', r'^/gmail/v1/users/[^/]+/messages$', 'insert'),
+              ('GET',  r'^/gmail/v1/users/[^/]+/messages/([^/]+)$', 'get'),
+              ('GET',  r'^/gmail/v1/users/[^/]+/messages/([^/]+)/attachments/([^/]+)$',
+               'attachment'),
+              ('GET',  r'^/gmail/v1/users/[^/]+/threads$', 'threads_list'),
+              ('GET',  r'^/gmail/v1/users/[^/]+/threads/([^/]+)$', 'thread'),
+              ('GET',  r'^/gmail/v1/users/[^/]+/history$', 'history')]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, verb):
+        url    = urlparse(self.path)
+        params = parse_qs(url.query)
+        for method, pattern, name in self.routes:
+            match = re.match(pattern, url.path)
+            if method == verb and match:
+                break
+        else:
+            return self.reply('unknown', 404, error(404, 'Not Found'))
+
+        server = self.server
+        if name not in ['discovery', 'stats']:
+            if server.latency:
+                time.sleep(random.expovariate(1 / server.latency))
+
+            if server.throttled():
+                return self.reply(name, 429, error(429, 'Rate Limit Exceeded'))
+
+            if random.random() < server.error_rate:
+                return self.reply(name, 500, error(500, 'Backend Error'))
+
+        try:
+            status, body = getattr(self, 'api_' + name)(params, *match.groups())
+        except KeyError:
+            status, body = 404, error(404, 'Requested entity was not found.')
+
+        self.reply(name, status, body)
+
+    def reply(self, name, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.server.count(name, status)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Endpoints
+    # ---------
+
+    def api_discovery(self, params):
+        return 200, discovery_document(self.server.root)
+
+    def api_stats(self, params):
+        with self.server.lock:
+            return 200, dict(self.server.stats)
+
+    def api_list(self, params, threads = False):
+        after, before = parse_query(params.get('q', [''])[0])
+        size  = int(params.get('maxResults', ['100'])[0])
+        start = int(params.get('pageToken', ['0'])[0])
+        msgs  = self.server.msgs
+        ids   = [mid for mid in self.server.order
+                 if after <= int(msgs[mid]['internalDate']) // 1000 < before]
+
+        kind = 'threads' if threads else 'messages'
+        if threads:
+            # Threads with a message in the window, latest activity first
+            seen   = set()
+            thrids = []
+            for mid in ids:
+                thrid = msgs[mid]['threadId']
+                if thrid not in seen:
+                    seen.add(thrid)
+                    thrids += [thrid]
+
+            ids = thrids
+
+        page = ids[start:start + size]
+        if threads:
+            body = {kind: [{'id': thrid} for thrid in page]}
+        else:
+            body = {kind: [{'id': mid, 'threadId': msgs[mid]['threadId']}
+                           for mid in page]}
+
+        body['resultSizeEstimate'] = len(ids)
+        if start + size < len(ids):
+            body['nextPageToken'] = str(start + size)
+
+        if not page:
+            del body[kind]
+
+        return 200, body
+
+    def api_threads_list(self, params):
+        return self.api_list(params, threads = True)
+
+    def api_thread(self, params, thrid):
+        msgids = self.server.threads[thrid]
+        return 200, {'id':       thrid,
+                     'messages': [self.api_get(params, mid)[1]
+                                  for mid in msgids]}
+
+    def api_get(self, params, msgid):
+        msg    = self.server.msgs[msgid]
+        format = params.get('format', ['full'])[0]
+        if format == 'minimal':
+            msg = dict((k, v) for k, v in msg.items() if k != 'payload')
+        elif format == 'metadata':
+            names = [n.lower() for n in params.get('metadataHeaders', [])]
+            heads = [h for h in msg['payload']['headers']
+                     if not names or h['name'].lower() in names]
+            msg   = dict((k, v) for k, v in msg.items() if k != 'payload')
+            msg['payload'] = {'mimeType': 'multipart/mixed', 'headers': heads}
+
+        return 200, msg
+
+    def api_attachment(self, params, msgid, attid):
+        if attid in self.server.att_bodies:
+            return 200, self.server.att_bodies[attid]
+
+        return 200, fixtures.att_data(attid, self.server.atts[attid])
+
+    def api_insert(self, params):
+        length = int(self.headers.get('Content-Length', 0))
+        body   = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+        return 200, self.server.insert(body)
+
+    def api_history(self, params):
+        start = int(params['startHistoryId'][0])
+        msgs  = self.server.msgs
+        added = [msgs[mid] for mid in self.server.order
+                 if int(msgs[mid]['historyId']) > start]
+        last  = max([int(msg['historyId']) for msg in msgs.values()] + [start])
+        return 200, {'history': [{'id': msg['historyId'],
+                                  'messagesAdded': [{'message': {
+                                      'id': msg['id'],
+                                      'threadId': msg['threadId']}}]}
+                                 for msg in added],
+                     'historyId': str(last)}
+
+def mime_payload(part, msgid, att_bodies, part_id = ''):
+    """Gmail API payload of email.message part, as messages.get has it
+
+    Bodies of parts with a file name go into att_bodies (by attachment
+    id) and are left out, as Gmail leaves out attachment data.
+    """
+
+    payload = {'partId':   part_id,
+               'mimeType': part.get_content_type(),
+               'filename': part.get_filename() or '',
+               'headers':  [{'name': name, 'value': value}
+                            for name, value in part.items()]}
+    if part.is_multipart():
+        prefix = part_id + '.' if part_id else ''
+        payload['body']  = {'size': 0}
+        payload['parts'] = [mime_payload(sub, msgid, att_bodies,
+                                         prefix + str(n))
+                            for n, sub in enumerate(part.get_payload())]
+        return payload
+
+    data = part.get_payload(decode = True) or b''
+    body = {'size': len(data),
+            'data': base64.urlsafe_b64encode(data).decode('ascii')}
+    if payload['filename']:
+        att_id = '%s-%s' % (msgid, part_id or '0')
+        att_bodies[att_id] = dict(body, attachmentId = att_id)
+        body = {'size': len(data), 'attachmentId': att_id}
+
+    payload['body'] = body
+    return payload
+
+def error(code, message):
+    return {'error': {'code': code,
+                      'message': message,
+                      'errors': [{'domain': 'global', 'message': message}]}}
+
+def parse_query(query):
+    """Epoch seconds window [after, before) from a Gmail search query
+
+    after:/before: take YYYY-MM-DD, YYYY/MM/DD or epoch seconds; dates
+    are read as UTC midnight. Other search terms are ignored.
+    """
+
+    window = {'after': 0, 'before': 2 ** 40}
+    for key, value in re.findall(r'(after|before):(\S+)', query):
+        if re.match(r'^\d+$', value):
+            window[key] = int(value)
+        else:
+            day = datetime.datetime.strptime(value.replace('/', '-'), '%Y-%m-%d')
+            window[key] = int((day - datetime.datetime(1970, 1, 1)).total_seconds())
+
+    return window['after'], window['before']
+
+def discovery_document(root):
+    """Discovery document for the implemented methods, served from root"""
+
+    def param(kind, location, required = False, repeated = False):
+        spec = {'type': kind, 'location': location}
+        if required:
+            spec['required'] = True
+
+        if repeated:
+            spec['repeated'] = True
+
+        return spec
+
+    user = {'userId': param('string', 'path', required = True)}
+    def method(name, http, route, params, order, response, request = None):
+        spec = {'id':             'gmail.users.' + name,
+                'path':           route,
+                'httpMethod':     http,
+                'parameters':     dict(user, **params),
+                'parameterOrder': order,
+                'response':       {'$ref': response}}
+        if request:
+            spec['request'] = {'$ref': request}
+
+        return spec
+
+    messages = {
+        'list': method('messages.list', 'GET', '{userId}/messages',
+                       {'q':          param('string', 'query'),
+                        'maxResults': param('integer', 'query'),
+                        'pageToken':  param('string', 'query'),
+                        'labelIds':   param('string', 'query', repeated = True)},
+                       ['userId'], 'ListMessagesResponse'),
+        'get': method('messages.get', 'GET', '{userId}/messages/{id}',
+                      {'id':              param('string', 'path', required = True),
+                       'format':          param('string', 'query'),
+                       'metadataHeaders': param('string', 'query', repeated = True)},
+                      ['userId', 'id'], 'Message'),
+        'insert': method('messages.insert', 'POST', '{userId}/messages', {},
+                         ['userId'], 'Message', request = 'Message')}
+
+    attachments = {
+        'get': method('messages.attachments.get', 'GET',
+                      '{userId}/messages/{messageId}/attachments/{id}',
+                      {'messageId': param('string', 'path', required = True),
+                       'id':        param('string', 'path', required = True)},
+                      ['userId', 'messageId', 'id'], 'MessagePartBody')}
+
+    threads = {
+        'list': method('threads.list', 'GET', '{userId}/threads',
+                       {'q':          param('string', 'query'),
+                        'maxResults': param('integer', 'query'),
+                        'pageToken':  param('string', 'query'),
+                        'labelIds':   param('string', 'query', repeated = True)},
+                       ['userId'], 'ListThreadsResponse'),
+        'get': method('threads.get', 'GET', '{userId}/threads/{id}',
+                      {'id':              param('string', 'path', required = True),
+                       'format':          param('string', 'query'),
+                       'metadataHeaders': param('string', 'query', repeated = True)},
+                      ['userId', 'id'], 'Thread')}
+
+    history = {
+        'list': method('history.list', 'GET', '{userId}/history',
+                       {'startHistoryId': param('string', 'query'),
+                        'maxResults':     param('integer', 'query'),
+                        'pageToken':      param('string', 'query')},
+                       ['userId'], 'ListHistoryResponse')}
+
+    schemas = ['ListMessagesResponse', 'Message', 'MessagePartBody',
+               'ListThreadsResponse', 'Thread', 'ListHistoryResponse']
+
+    return {'kind':             'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id':               'gmail:v1',
+            'name':             'gmail',
+            'version':          'v1',
+            'protocol':         'rest',
+            'rootUrl':          root,
+            'servicePath':      'gmail/v1/users/',
+            'baseUrl':          root + 'gmail/v1/users/',
+            'batchPath':        'batch/gmail/v1',
+            'parameters':       {'fields': param('string', 'query'),
+                                 'alt':    param('string', 'query')},
+            'schemas':          dict((s, {'id': s, 'type': 'object'})
+                                     for s in schemas),
+            'resources':        {'users': {'resources': {
+                'messages': {'methods':   messages,
+                             'resources': {'attachments': {'methods': attachments}}},
+                'threads':  {'methods': threads},
+                'history':  {'methods': history}}}}}
+
+if __name__ == '__main__':
+    main()
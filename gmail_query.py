@@ -19,6 +19,11 @@ Usage
 $ gmail-query.py
 $ gmail-query.py -d 2016-06-01
 $ gmail-query.py -d 2016-06-01 -o ~/Downloads/email
+$ gmail-query.py backfill 2016-01-01 2016-12-31
+$ gmail-query.py watch --interval 30
+$ gmail-query.py --plan backfill 2016-01-01 2016-12-31
+$ gmail-query.py --queue /shared/queue queue 2016-01-01 2016-12-31
+$ gmail-query.py --queue /shared/queue work
 
 # From Python
 >>> from gmail_query import gmail_query
@@ -26,6 +31,7 @@ $ gmail-query.py -d 2016-06-01 -o ~/Downloads/email
 >>> query = gmail_query(outdir = '/path/to/output')
 >>> query.query()
 >>> query.query(todays = '2016-06-01', bdays = 7)
+>>> query.backfill('2016-01-01', '2016-12-31')
 
 Notes
 -----
@@ -48,21 +54,35 @@ and this needs to handle both.
 from __future__ import division, print_function
 from dateutil.parser import parse
 from bitmath import parse_string
+from collections import deque
+from contextlib import contextmanager
 from operator import itemgetter
 from apiclient import discovery
 from oauth2client import client
 from oauth2client import tools
+from apiclient.errors import HttpError
+from multiprocessing.pool import ThreadPool
 from dateutil import tz
 from shutil import move
 from os import path
 import pypandoc as pandoc
 import pandas as pd
 import oauth2client
+import threading
+import functools
+import importlib
+import hashlib
+import errno
+import io
+import signal
 import httplib2
 import datetime
+import calendar
+import random
 import base64
 import string
 import json
+import time
 import sys
 import os
 import re
@@ -84,7 +104,27 @@ try:
     unicode is unicode
 except NameError:
     def unicode(x):
-        return str(x, 'utf-8')
+        return x if isinstance(x, str) else str(x, 'utf-8')
+
+def to_bytes(x):
+    return x.encode('utf-8') if isinstance(x, type(u'')) else x
+
+try:
+    from HTMLParser import HTMLParser
+    from htmlentitydefs import name2codepoint
+except ImportError:
+    from html.parser import HTMLParser
+    from html.entities import name2codepoint
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+try:
+    b64_table = bytes.maketrans(b'-_', b'+/')
+except AttributeError:
+    b64_table = string.maketrans('-_', '+/')
 
 # ---------------------------------------------------------------------
 # Main function wrapper
@@ -104,23 +144,222 @@ ext_dict = {'eml': '.eml',
             'plain': '.txt',
             'rst': '.rst'}
 
+# Output types the native renderer (html_renderer) produces without pandoc
+native_formats = ['html',
+                  'html5',
+                  'markdown',
+                  'markdown_github',
+                  'markdown_mmd',
+                  'markdown_phpextra',
+                  'markdown_strict',
+                  'plain']
+
+# Gmail API quota units per call; the per-user limit is 250 units/second
+quota_units = {'messages.list': 5,
+               'messages.get': 5,
+               'messages.attachments.get': 5,
+               'messages.insert': 25,
+               'threads.list': 10,
+               'threads.get': 10}
+
+# Thread folder layouts within a day folder (see layout_shard)
+layouts = ['flat', 'hour', 'domain', 'hash']
+
+# Fields kept from messages.get and threads.get (labels, snippets and
+# history ids are unused)
+msg_fields    = 'id,threadId,internalDate,sizeEstimate,payload'
+thread_fields = 'id,messages(%s)' % msg_fields
+
+# Headers parse_msg reads (lowercase)
+head_names = frozenset(['from', 'to', 'cc', 'subject', 'date'])
+
+# Fields kept by --plan: part sizes (plan_depth levels of nesting deep),
+# no data. Messages nested that deep are got again without the mask
+# (see get_meta), since the parts below would be cut off.
+plan_depth  = 8
+plan_parts  = 'filename,body(size,attachmentId)'
+for depth in range(plan_depth):
+    plan_parts = 'filename,body(size,attachmentId),parts(%s)' % plan_parts
+
+plan_fields = 'id,threadId,internalDate,sizeEstimate,payload(%s)' % plan_parts
+
 def main():
-    cfg_init(cfgfile)
+    # A local API stand-in (--api-root) needs no config file
+    if not any(arg.startswith('--api-root') for arg in sys.argv[1:]):
+        cfg_init(cfgfile)
+
     def_args = args_fallback()
-    cfg_args = args_config(cfgfile, def_args)
+    cfg_args = args_config(cfgfile, def_args, required = False)
     cli_args = args_cli(cfg_args)
 
-    query = gmail_query(cli_args.outdir, flags = cli_args)
-    query.query(todays  = cli_args.date,
-                bdays   = cli_args.bdays,
-                otype   = cli_args.otype,
-                ext     = cli_args.ext,
-                att_get = cli_args.att_get,
-                att_max = cli_args.att_max,
-                mail    = cli_args.mail,
-                first   = cli_args.first,
-                sort_case  = cli_args.sort_case,
-                sort_rules = cli_args.sort_file)
+    if cli_args.accounts is not None:
+        query_accounts(cli_args, cli_args.accounts)
+    else:
+        query = gmail_query(cli_args.outdir,
+                            flags   = cli_args,
+                            workers = cli_args.workers)
+        run_query(query, cli_args)
+
+def run_query(query, cli_args, stop = None):
+    """Run the query (backfill, watch, queue, work) requested from the command line
+
+    Kwargs:
+        stop: threading.Event that stops watch (see gmail_query.watch)
+    """
+
+    if cli_args.command[:1] in [['queue'], ['work']]:
+        folder = cli_args.queue
+        if query.account is not None:
+            folder = os.path.join(folder, query.account)
+
+        queue = work_queue(folder, cli_args.lease)
+
+    if cli_args.plan:
+        backfill = cli_args.command[:1] in [['backfill'], ['queue']]
+        query.plan(todays  = cli_args.date,
+                   bdays   = cli_args.bdays,
+                   start   = cli_args.command[1] if backfill else None,
+                   end     = cli_args.command[2] if backfill else None,
+                   otype   = cli_args.otype,
+                   ext     = cli_args.ext,
+                   att_get = cli_args.att_get,
+                   att_max = cli_args.att_max,
+                   mail    = cli_args.mail,
+                   first   = cli_args.first)
+    elif cli_args.command[:1] == ['backfill']:
+        query.backfill(cli_args.command[1],
+                       cli_args.command[2],
+                       otype   = cli_args.otype,
+                       ext     = cli_args.ext,
+                       att_get = cli_args.att_get,
+                       att_max = cli_args.att_max,
+                       mail    = cli_args.mail,
+                       first   = cli_args.first,
+                       sort_case  = cli_args.sort_case,
+                       sort_rules = cli_args.sort_file)
+    elif cli_args.command[:1] == ['queue']:
+        query.enqueue(cli_args.command[1],
+                      cli_args.command[2],
+                      queue,
+                      mail = cli_args.mail)
+    elif cli_args.command[:1] == ['work']:
+        query.work(queue,
+                   otype   = cli_args.otype,
+                   ext     = cli_args.ext,
+                   att_get = cli_args.att_get,
+                   att_max = cli_args.att_max,
+                   mail    = cli_args.mail,
+                   first   = cli_args.first,
+                   sort_case  = cli_args.sort_case,
+                   sort_rules = cli_args.sort_file)
+    elif cli_args.command[:1] == ['watch']:
+        query.watch(interval = cli_args.interval,
+                    otype    = cli_args.otype,
+                    ext      = cli_args.ext,
+                    att_get  = cli_args.att_get,
+                    att_max  = cli_args.att_max,
+                    first    = cli_args.first,
+                    sort_case  = cli_args.sort_case,
+                    sort_rules = cli_args.sort_file,
+                    stop       = stop)
+    else:
+        query.query(todays  = cli_args.date,
+                    bdays   = cli_args.bdays,
+                    otype   = cli_args.otype,
+                    ext     = cli_args.ext,
+                    att_get = cli_args.att_get,
+                    att_max = cli_args.att_max,
+                    mail    = cli_args.mail,
+                    first   = cli_args.first,
+                    sort_case  = cli_args.sort_case,
+                    sort_rules = cli_args.sort_file)
+
+def stop_on_signals(stop):
+    """Set threading.Event stop on SIGINT and SIGTERM
+
+    Only the main thread can install signal handlers (ValueError).
+    """
+
+    def handler(signum, frame):
+        print("Stopping after the current poll...")
+        stop.set()
+
+    signal.signal(signal.SIGINT,  handler)
+    signal.signal(signal.SIGTERM, handler)
+
+def query_accounts(cli_args, names = None, cfgfile = cfgfile):
+    """Run the query for several accounts in one process
+
+    Args:
+        cli_args: args_cli object
+
+    Kwargs:
+        names: Account names (default is every [Account <name>] section)
+
+    Returns:
+        Each account is queried into its own output root (its
+        output_folder or <outdir>/<name>) with its own credentials and
+        quota budget. All accounts share one worker pool that takes
+        turns between accounts.
+    """
+
+    known = account_names(cfgfile)
+    names = names if names else known
+    if not names:
+        raise Warning("Add [Account <name>] sections to ~/.gmail_query.conf")
+
+    for name in names:
+        if name not in known:
+            raise Warning("No [Account {}] section in {}".format(name, cfgfile))
+
+    # Credentials may need user input, so set up accounts one at a time
+    pool    = fair_pool(cli_args.workers)
+    queries = []
+    for name in names:
+        cfg_account = args_config(cfgfile, args_fallback(), account = name)
+        outdir  = cfg_account.account_outdir
+        outdir  = outdir if outdir else os.path.join(cli_args.outdir, name)
+        queries += [gmail_query(os.path.expanduser(outdir),
+                                flags   = cli_args,
+                                cfgfile = cfgfile,
+                                workers = cli_args.workers,
+                                account = name,
+                                pool    = pool.account(name))]
+
+    # Account runners are not the main thread, so the main thread stops
+    # their watches; it waits with a timeout so the signals get through
+    stop = None
+    if cli_args.command[:1] == ['watch']:
+        stop = threading.Event()
+        stop_on_signals(stop)
+
+    def run_account(query):
+        try:
+            run_query(query, cli_args, stop)
+            status = 'done'
+        except Exception as e:
+            status = 'FAILED ({})'.format(e)
+
+        spent = (query.account, status, query.budget.calls, query.budget.units)
+        return "%s: %s; %d requests, %d quota units" % spent
+
+    runners = ThreadPool(len(queries))
+    try:
+        res = runners.map_async(run_account, queries)
+        while not res.ready():
+            res.wait(1)
+
+        print(os.linesep.join(res.get()))
+    finally:
+        runners.close()
+
+def account_names(cfgfile):
+    """Names of the [Account <name>] sections in cfgfile"""
+
+    cfgparser = ConfigParser()
+    cfgparser.read(cfgfile)
+    return [sec[len('Account '):].strip()
+            for sec in cfgparser.sections() if sec.startswith('Account ')]
 
 # ---------------------------------------------------------------------
 # Create .conf file, update .conf file
@@ -140,11 +379,29 @@ def cfg_init(cfgfile):
                    'Setup.output_ext': ["anything", ""],
                    'Setup.download_attachments': ["regex", "True|False"],
                    'Setup.max_attachment_size': ["anything", ""],
+                   'Setup.attachment_run_budget': ["anything", ""],
+                   'Setup.attachment_thread_budget': ["anything", ""],
+                   'Setup.fetch_threads': ["regex", "True|False"],
+                   'Setup.renderer': ["regex", "pandoc|native|auto"],
+                   'Setup.raw_body_size': ["anything", ""],
+                   'Setup.output_layout': ["regex", '|'.join(layouts)],
                    'Setup.query_days': ["regex", "\d+"],
                    'Setup.threaded_first': ["regex", "True|False"],
                    'Setup.notify_email': ["regex", "True|False"],
                    'Setup.sorting_rules': ["file", ""],
-                   'Setup.sorting_case_sensitive': ["regex", "True|False"]}
+                   'Setup.sorting_case_sensitive': ["regex", "True|False"],
+                   'Setup.workers': ["regex", "\d+"],
+                   'Setup.quota_rate': ["regex", "\d+"],
+                   'Setup.watch_interval': ["regex", "\d+"],
+                   'Setup.metrics_report': ["anything", ""],
+                   'Setup.metrics_prom': ["anything", ""],
+                   'Setup.metrics_mail': ["regex", "True|False"],
+                   'Setup.parquet_export': ["anything", ""],
+                   'Setup.queue_folder': ["anything", ""],
+                   'Setup.queue_lease': ["regex", "\d+"],
+                   'Setup.io_threads': ["regex", "\d+"],
+                   'Setup.fsync': ["regex", "\d+"],
+                   'Setup.api_root': ["anything", ""]}
 
         if not path.isfile(cfgfile):
             cfgparser    = RawConfigParser()
@@ -250,11 +507,29 @@ class args_fallback():
         self.ext       = ''
         self.att_get   = False
         self.att_max   = '20MiB'
+        self.att_run   = ''
+        self.att_thread = ''
+        self.threads   = False
+        self.renderer  = 'auto'
+        self.raw_size  = '2MiB'
+        self.layout    = 'flat'
         self.mail      = False
         self.first     = False
         self.sort_file = ''
         self.sort_case = False
         self.sort      = False
+        self.workers   = 8
+        self.quota_rate = 250
+        self.interval  = 60
+        self.metrics_report = ''
+        self.metrics_prom   = ''
+        self.metrics_mail   = False
+        self.parquet   = ''
+        self.queue     = ''
+        self.lease     = 600
+        self.api_root  = ''
+        self.io_threads = 8
+        self.fsync     = 0
 
 # ---------------------------------------------------------------------
 # Parse config file options
@@ -263,28 +538,74 @@ class args_config():
 
     """Parse arguments from configuration file"""
 
-    def __init__(self, cfgfile, fallback):
+    def __init__(self, cfgfile, fallback, account = None, required = True):
+        """Parse arguments from configuration file
+
+        Args:
+            cfgfile: Configuration file
+            fallback: args_fallback object
+
+        Kwargs:
+            account: Read the Gmail options from [Account <account>]
+                (secret and appname default to those under [Gmail]).
+            required: Raise a Warning if the Gmail options are missing.
+        """
+
         cfgparser = ConfigParser()
         cfgparser.read(cfgfile)
 
+        # A local API stand-in needs no Gmail credentials
+        try:
+            self.api_root = cfgparser.get('Setup', 'api_root')
+        except:
+            self.api_root = fallback.api_root
+
+        required = required and not self.api_root
+
         # Required
         # --------
 
+        section = 'Gmail' if account is None else 'Account ' + account
+        shared  = [section, 'Gmail']
+
         msg = 'Add {} = {} under [{}] in ~/.gmail_query.conf'
         try:
-            self.my_email = cfgparser.get('Gmail', 'email')
+            self.my_email = cfgparser.get(section, 'email')
+        except:
+            self.my_email = None
+            if required:
+                raise Warning(msg.format('email', 'g-mail', section))
+
+        try:
+            self.my_secret = cfg_get_first(cfgparser, shared, 'secret')
+        except:
+            self.my_secret = None
+            if required:
+                raise Warning(msg.format('secret', 'client_secret.json', section))
+
+        try:
+            self.my_appname = cfg_get_first(cfgparser, shared, 'appname')
         except:
-            raise Warning(msg.format('email', 'g-mail', 'Gmail'))
+            self.my_appname = None
+            if required:
+                raise Warning(msg.format('appname', 'API name', section))
 
+        # Each account keeps its own credential store and output root
         try:
-            self.my_secret = cfgparser.get('Gmail', 'secret')
+            credentials = cfgparser.get(section, 'credentials')
+            self.credentials = os.path.expanduser(credentials)
         except:
-            raise Warning(msg.format('secret', 'client_secret.json', 'Gmail'))
+            self.credentials = None
+            if account is not None:
+                credentials = 'gmail-query-{}.json'.format(account)
+                self.credentials = path.join(path.expanduser('~'),
+                                             '.credentials',
+                                             credentials)
 
         try:
-            self.my_appname = cfgparser.get('Gmail', 'appname')
+            self.account_outdir = cfgparser.get(section, 'output_folder')
         except:
-            raise Warning(msg.format('appname', 'API name', 'Gmail'))
+            self.account_outdir = None
 
         # Optional
         # --------
@@ -315,6 +636,36 @@ class args_config():
         except:
             self.att_max = fallback.att_max
 
+        try:
+            self.att_run = cfgparser.get('Setup', 'attachment_run_budget')
+        except:
+            self.att_run = fallback.att_run
+
+        try:
+            self.att_thread = cfgparser.get('Setup', 'attachment_thread_budget')
+        except:
+            self.att_thread = fallback.att_thread
+
+        try:
+            self.threads = cfgparser.getboolean('Setup', 'fetch_threads')
+        except:
+            self.threads = fallback.threads
+
+        try:
+            self.renderer = cfgparser.get('Setup', 'renderer')
+        except:
+            self.renderer = fallback.renderer
+
+        try:
+            self.raw_size = cfgparser.get('Setup', 'raw_body_size')
+        except:
+            self.raw_size = fallback.raw_size
+
+        try:
+            self.layout = cfgparser.get('Setup', 'output_layout')
+        except:
+            self.layout = fallback.layout
+
         try:
             self.bdays = cfgparser.getint('Setup', 'query_days')
         except:
@@ -341,6 +692,74 @@ class args_config():
         except:
             self.sort_case = fallback.sort_case
 
+        try:
+            self.workers = cfgparser.getint('Setup', 'workers')
+        except:
+            self.workers = fallback.workers
+
+        try:
+            self.quota_rate = cfgparser.getint('Setup', 'quota_rate')
+        except:
+            self.quota_rate = fallback.quota_rate
+
+        try:
+            self.interval = cfgparser.getint('Setup', 'watch_interval')
+        except:
+            self.interval = fallback.interval
+
+        try:
+            self.metrics_report = cfgparser.get('Setup', 'metrics_report')
+            self.metrics_report = os.path.expanduser(self.metrics_report)
+        except:
+            self.metrics_report = fallback.metrics_report
+
+        try:
+            self.metrics_prom = cfgparser.get('Setup', 'metrics_prom')
+            self.metrics_prom = os.path.expanduser(self.metrics_prom)
+        except:
+            self.metrics_prom = fallback.metrics_prom
+
+        try:
+            self.metrics_mail = cfgparser.getboolean('Setup', 'metrics_mail')
+        except:
+            self.metrics_mail = fallback.metrics_mail
+
+        try:
+            self.parquet = cfgparser.get('Setup', 'parquet_export')
+            self.parquet = os.path.expanduser(self.parquet)
+        except:
+            self.parquet = fallback.parquet
+
+        try:
+            self.queue = cfgparser.get('Setup', 'queue_folder')
+            self.queue = os.path.expanduser(self.queue)
+        except:
+            self.queue = fallback.queue
+
+        try:
+            self.lease = cfgparser.getint('Setup', 'queue_lease')
+        except:
+            self.lease = fallback.lease
+
+        try:
+            self.io_threads = cfgparser.getint('Setup', 'io_threads')
+        except:
+            self.io_threads = fallback.io_threads
+
+        try:
+            self.fsync = cfgparser.getint('Setup', 'fsync')
+        except:
+            self.fsync = fallback.fsync
+
+def cfg_get_first(cfgparser, sections, option):
+    """Get option from the first section in sections that has it"""
+
+    for section in sections:
+        if cfgparser.has_option(section, option):
+            return cfgparser.get(section, option)
+
+    raise Warning("'{}' not found".format(option))
+
 # ---------------------------------------------------------------------
 # Parse CLI arguments
 
@@ -414,6 +833,26 @@ class args_cli():
                             help     = "Largest attachment size.",
                             required = False)
 
+        parser.add_argument('--attachment-run-budget',
+                            dest     = 'att_run',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'SIZE',
+                            default  = [defaults.att_run],
+                            help     = "Most attachment data to download "
+                                       "per run.",
+                            required = False)
+
+        parser.add_argument('--attachment-thread-budget',
+                            dest     = 'att_thread',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'SIZE',
+                            default  = [defaults.att_thread],
+                            help     = "Most attachment data to download "
+                                       "per thread.",
+                            required = False)
+
         parser.add_argument('-b', '--days-back',
                             dest     = 'days_back',
                             type     = int,
@@ -450,19 +889,228 @@ class args_cli():
                             help     = "Sorting rules are case-sensitive.",
                             required = False)
 
+        parser.add_argument('--renderer',
+                            dest     = 'renderer',
+                            type     = str,
+                            nargs    = 1,
+                            choices  = ['pandoc', 'native', 'auto'],
+                            default  = [defaults.renderer],
+                            help     = "Convert bodies with pandoc, the "
+                                       "native renderer, or native when it "
+                                       "supports the output type (auto).",
+                            required = False)
+
+        parser.add_argument('--raw-body-size',
+                            dest     = 'raw_size',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'SIZE',
+                            default  = [defaults.raw_size],
+                            help     = "Write bodies larger than this as "
+                                       "received, without conversion.",
+                            required = False)
+
+        parser.add_argument('--layout',
+                            dest     = 'layout',
+                            type     = str,
+                            nargs    = 1,
+                            choices  = layouts,
+                            default  = [defaults.layout],
+                            help     = "Put new thread folders in shard "
+                                       "folders by hour, sender domain or "
+                                       "thread id hash (default flat).",
+                            required = False)
+
+        parser.add_argument('--threads',
+                            dest     = 'threads',
+                            action   = 'store_true',
+                            help     = "Get whole threads (threads.get) "
+                                       "instead of single messages.",
+                            required = False)
+
+        parser.add_argument('--plan',
+                            dest     = 'plan',
+                            action   = 'store_true',
+                            help     = "Estimate messages, bytes, quota and "
+                                       "run time; write nothing.",
+                            required = False)
+
+        parser.add_argument('-w', '--workers',
+                            dest     = 'workers',
+                            type     = int,
+                            nargs    = 1,
+                            metavar  = 'WORKERS',
+                            default  = [defaults.workers],
+                            help     = "Concurrent API requests.",
+                            required = False)
+
+        parser.add_argument('--io-threads',
+                            dest     = 'io_threads',
+                            type     = int,
+                            nargs    = 1,
+                            metavar  = 'THREADS',
+                            default  = [defaults.io_threads],
+                            help     = "Threads writing output files "
+                                       "(0 writes them serially).",
+                            required = False)
+
+        parser.add_argument('--fsync',
+                            dest     = 'fsync',
+                            type     = int,
+                            nargs    = 1,
+                            metavar  = 'FILES',
+                            default  = [defaults.fsync],
+                            help     = "fsync output every FILES files "
+                                       "(0 never fsyncs).",
+                            required = False)
+
+        parser.add_argument('--interval',
+                            dest     = 'interval',
+                            type     = int,
+                            nargs    = 1,
+                            metavar  = 'SECONDS',
+                            default  = [defaults.interval],
+                            help     = "Seconds between polls in watch mode.",
+                            required = False)
+
+        parser.add_argument('--metrics-report',
+                            dest     = 'metrics_report',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'JSON',
+                            default  = [defaults.metrics_report],
+                            help     = "Write run metrics to this JSON file.",
+                            required = False)
+
+        parser.add_argument('--metrics-prom',
+                            dest     = 'metrics_prom',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'PROM',
+                            default  = [defaults.metrics_prom],
+                            help     = "Write run metrics to this Prometheus "
+                                       "textfile.",
+                            required = False)
+
+        parser.add_argument('--metrics-mail',
+                            dest     = 'metrics_mail',
+                            action   = 'store_true',
+                            help     = "Add run metrics to notification e-mail.",
+                            required = False)
+
+        parser.add_argument('--parquet',
+                            dest     = 'parquet',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'DIR',
+                            default  = [defaults.parquet],
+                            help     = "Add a Parquet file with the metadata "
+                                       "of the messages written to DIR.",
+                            required = False)
+
+        parser.add_argument('--queue',
+                            dest     = 'queue',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'DIR',
+                            default  = [defaults.queue],
+                            help     = "Work queue folder shared by the queue "
+                                       "and work commands.",
+                            required = False)
+
+        parser.add_argument('--lease',
+                            dest     = 'lease',
+                            type     = int,
+                            nargs    = 1,
+                            metavar  = 'SECONDS',
+                            default  = [defaults.lease],
+                            help     = "Seconds a worker may hold a queued "
+                                       "task without renewing it.",
+                            required = False)
+
+        parser.add_argument('--api-root',
+                            dest     = 'api_root',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'URL',
+                            default  = [defaults.api_root],
+                            help     = "Use a local Gmail API stand-in.",
+                            required = False)
+
+        parser.add_argument('--accounts',
+                            dest     = 'accounts',
+                            type     = str,
+                            nargs    = 1,
+                            metavar  = 'NAMES',
+                            default  = None,
+                            help     = "Query these [Account] sections "
+                                       "(comma-separated; all for every "
+                                       "one).",
+                            required = False)
+
+        parser.add_argument('command',
+                            type     = str,
+                            nargs    = '*',
+                            metavar  = 'COMMAND',
+                            help     = "Optional mode: backfill START END, "
+                                       "watch, queue START END or work.")
+
         self.flags     = parser.parse_args()
+        self.command   = self.flags.command
+        if self.command and self.command[0] not in ['backfill', 'watch',
+                                                    'queue', 'work']:
+            parser.error("Unknown command '{}'".format(self.command[0]))
+
+        if self.command[:1] == ['backfill'] and len(self.command) != 3:
+            parser.error("Usage: backfill START END (e.g. 2016-01-01)")
+
+        if self.command[:1] == ['queue'] and len(self.command) != 3:
+            parser.error("Usage: queue START END (e.g. 2016-01-01)")
+
+        if self.command[:1] in [['queue'], ['work']] and not self.flags.queue[0]:
+            parser.error("{} needs a queue folder (--queue DIR)".format(
+                self.command[0]))
+
+        if self.flags.plan and self.command[:1] in [['watch'], ['work']]:
+            parser.error("--plan estimates a query or a backfill, not {}".format(
+                self.command[0]))
+
         self.outdir    = os.path.expanduser(self.flags.out[0])
         self.date      = self.flags.date[0]
         self.otype     = self.flags.otype[0]
         self.ext       = self.flags.ext[0]
         self.att_get   = self.flags.attachments or defaults.att_get
         self.att_max   = self.flags.max_size[0]
+        self.att_run   = self.flags.att_run[0]
+        self.att_thread = self.flags.att_thread[0]
+        self.threads   = self.flags.threads or defaults.threads
+        self.plan      = self.flags.plan
+        self.renderer  = self.flags.renderer[0]
+        self.raw_size  = self.flags.raw_size[0]
+        self.layout    = self.flags.layout[0]
         self.bdays     = self.flags.days_back[0]
         self.first     = self.flags.first or defaults.first
         self.mail      = self.flags.mail or defaults.mail
         self.sort_file = os.path.expanduser(self.flags.sort_rules[0])
         self.sort_case = self.flags.case or defaults.sort_case
         self.sort      = self.sort_file != ''
+        self.workers   = self.flags.workers[0]
+        self.accounts  = None
+        if self.flags.accounts is not None:
+            self.accounts = [name.strip()
+                             for name in self.flags.accounts[0].split(',')
+                             if name.strip()]
+            self.accounts = [] if self.accounts == ['all'] else self.accounts
+        self.interval  = self.flags.interval[0]
+        self.metrics_report = os.path.expanduser(self.flags.metrics_report[0])
+        self.metrics_prom   = os.path.expanduser(self.flags.metrics_prom[0])
+        self.metrics_mail   = self.flags.metrics_mail or defaults.metrics_mail
+        self.parquet   = os.path.expanduser(self.flags.parquet[0])
+        self.queue     = os.path.expanduser(self.flags.queue[0])
+        self.lease     = self.flags.lease[0]
+        self.api_root  = self.flags.api_root[0]
+        self.io_threads = self.flags.io_threads[0]
+        self.fsync     = self.flags.fsync[0]
 
 # ---------------------------------------------------------------------
 # Main query wrapper
@@ -489,18 +1137,59 @@ class gmail_query():
     >>> query.query('2016-01-01')
     """
 
-    def __init__(self, outdir, flags = None, cfgfile = cfgfile):
+    def __init__(self,
+                 outdir,
+                 flags   = None,
+                 cfgfile = cfgfile,
+                 workers = None,
+                 account = None,
+                 pool    = None):
         """Query gmail e-mail for the day
 
         Kwargs:
             outdir: Output directory
+            workers: Concurrent API requests (default from config)
+            account: Use the [Account <account>] section of cfgfile
+            pool: Worker pool to share with other gmail_query objects
         """
 
+        # A local API stand-in (--api-root) needs no Gmail credentials
         def_args = args_fallback()
-        cfg_args = args_config(cfgfile, def_args)
+        cfg_args = args_config(cfgfile, def_args, account = account,
+                               required = not getattr(flags, 'api_root', ''))
+        workers  = cfg_args.workers if workers is None else workers
 
+        self.account  = account
         self.outmail  = cfg_args.my_email
+        self.metrics  = run_metrics(account)
+        self.metrics_report = getattr(flags, 'metrics_report',
+                                      cfg_args.metrics_report)
+        self.metrics_prom   = getattr(flags, 'metrics_prom',
+                                      cfg_args.metrics_prom)
+        self.metrics_mail   = getattr(flags, 'metrics_mail',
+                                      cfg_args.metrics_mail)
+        if account is not None:
+            self.metrics_report = suffix_fname(self.metrics_report, account)
+            self.metrics_prom   = suffix_fname(self.metrics_prom, account)
         self.outdir   = outdir
+        self.writer   = output_writer(getattr(flags, 'io_threads',
+                                              cfg_args.io_threads),
+                                      getattr(flags, 'fsync', cfg_args.fsync))
+        self.manifest = output_manifest(outdir)
+        self.att_run  = getattr(flags, 'att_run', cfg_args.att_run)
+        self.att_thread = getattr(flags, 'att_thread', cfg_args.att_thread)
+        self.att_budget = att_budget(self.att_run, self.att_thread)
+        self.fetch_threads = getattr(flags, 'threads', cfg_args.threads)
+        self.renderer = getattr(flags, 'renderer', cfg_args.renderer)
+        self.raw_size = getattr(flags, 'raw_size', cfg_args.raw_size)
+        self.raw_max  = None
+        if self.raw_size:
+            self.raw_max = int(parse_string(self.raw_size).bytes)
+        self.layout   = getattr(flags, 'layout', cfg_args.layout)
+        self.parquet  = getattr(flags, 'parquet', cfg_args.parquet)
+        self.export   = None
+        if self.parquet:
+            self.export = parquet_export(self.parquet, account)
         self.timezone = tz.tzlocal()
         self.tzstr    = datetime.datetime.now(self.timezone).tzname()
 
@@ -515,15 +1204,37 @@ class gmail_query():
         # Create gmail messages object
         # ----------------------------
 
-        credentials   = get_credentials(app_name,
-                                        client_secret_file,
-                                        scopes,
-                                        flags)
-        http          = credentials.authorize(httplib2.Http())
-        service       = discovery.build('gmail', 'v1', http    = http)
+        self.api_root = getattr(flags, 'api_root', cfg_args.api_root)
+        if self.api_root:
+            # Local stand-in (benchmarks/stub_server.py); no OAuth
+            credentials = None
+            discovery_url = self.api_root.rstrip('/') + \
+                '/discovery/v1/apis/{api}/{apiVersion}/rest'
+            service = discovery.build('gmail', 'v1',
+                                      http = httplib2.Http(),
+                                      discoveryServiceUrl = discovery_url)
+        else:
+            credentials = get_credentials(app_name,
+                                          client_secret_file,
+                                          scopes,
+                                          flags,
+                                          cfg_args.credentials)
+            http    = credentials.authorize(httplib2.Http())
+            service = discovery.build('gmail', 'v1', http = http)
+
         self.messages = service.users().messages()
+        self.threads  = service.users().threads()
         self.cfg_args = cfg_args
 
+        # Requests are built from the shared service but executed over a
+        # per-thread connection (httplib2 is not thread-safe); all threads
+        # draw from one request budget.
+        self.credentials = credentials
+        self.local  = threading.local()
+        self.pool   = ThreadPool(workers) if pool is None else pool
+        self.budget = request_budget(workers, cfg_args.quota_rate)
+        self.workers = workers
+
     def query(self,
               todays  = None,
               bdays   = None,
@@ -549,6 +1260,8 @@ class gmail_query():
             e-mails message with query results.
         """
 
+        self.metrics = run_metrics(self.account)
+        self.att_budget = att_budget(self.att_run, self.att_thread)
         if bdays is None:
             bdays = self.cfg_args.bdays
 
@@ -576,12 +1289,15 @@ class gmail_query():
         if sort_rules is None:
             sort_rules = self.cfg_args.sort_file
 
-        ptypes = pandoc.get_pandoc_formats()[1]
+        ptypes = output_types(self.renderer, otype, self.metrics)
         if otype not in ptypes and not otype == 'eml':
             raise Warning("Output type must be: {}".format(', '.join(ptypes)))
 
         max_size = parse_string(att_max) if att_get else None
-        sort = sort_rules != ''
+        ext      = ext_dict[otype] if ext == '' else ext
+        options  = render_options(otype, ext, max_size, first,
+                                  self.att_budget, self.renderer,
+                                  self.raw_max)
 
         # Get date to query, recursively create output dir
         # ------------------------------------------------
@@ -595,501 +1311,3343 @@ class gmail_query():
         # -----------
 
         try:
-            df  = self.query_todays(todays, bdays, first, otype, max_size)
+            df  = self.query_todays(todays, bdays, first, otype, max_size,
+                                    options)
         except:
             df  = None
             res = "Gmail query FAILED"
 
-        ext = ext_dict[otype] if ext == '' else ext
         if df is not None:
-            print_df_query(df, outdir, self.tzstr, otype, ext)
-            if sort:
-                if os.path.isfile(sort_rules):
-                    try:
-                        self.sort_query(sort_rules, sort_case)
-                    except:
-                        print("Sorting failed. Check '{}'".format(sort_rules))
-                else:
-                    print("'{}' not found. Can't sort.".format(sort_rules))
+            self.write_query(df, outdir, otype, ext, sort_rules, sort_case,
+                             options)
             res = "Success! See output folder:" + os.linesep + outdir
+        elif self.metrics.counters.get('messages_skipped'):
+            res = 'No new e-mail %s' % todays
         else:
             res = 'No e-mail %s' % todays
 
         # Report success/fail
         # -------------------
 
-        if mail:
-            msg = ["Content-Type: text/plain; charset=\"UTF-8\"",
-                   "MIME-Version: 1.0",
-                   "Content-Transfer-Encoding: message/rfc2822",
-                   "To: <%s>" % self.outmail,
-                   "From: <%s>" % self.outmail,
-                   "Subject: Mail Dump for %s" % todays, "", res]
-
-            b = base64.b64encode(os.linesep.join(msg))
-            b = b.replace('+', '-').replace('/', '_')
-            self.messages.insert(userId = 'me', body = {'raw': b}).execute()
-        else:
-            print(res)
-
-    def query_todays(self, todays, bdays, first, otype, msize):
-        """Get all of today's messages
+        self.manifest.save(compact = True)
+        self.flush_export()
+        self.notify("Mail Dump for %s" % todays, res, mail)
+
+    def backfill(self,
+                 start,
+                 end,
+                 otype   = None,
+                 ext     = None,
+                 att_get = None,
+                 att_max = None,
+                 mail    = None,
+                 first   = None,
+                 sort_case  = None,
+                 sort_rules = None,
+                 shards     = 4):
+
+        """Query Gmail e-mail for every day from start to end
 
         Args:
-            todays: Messages from date.
-            bdays: Days back to look for e-mail.
+            start: First day to query (e.g. 2016-01-01)
+            end: Last day to query (inclusive)
 
-        Returns:
-            df: Data frame with today's messages
+        Kwargs:
+            shards: Number of days processed at the same time. All days
+                share the same worker pool and request budget.
 
+        Returns:
+            Each day is written to its own outdir/<day> folder, exactly
+            as query(todays = day) would, and sorted if requested.
         """
 
-        # Gmail queries date >= after and date < before
-        todaydt  = datetime.datetime.strptime(todays, "%Y-%m-%d")
-        tomorrow = todaydt + datetime.timedelta(days = 1)
-        tomorrow = tomorrow.strftime("%Y-%m-%d")
-        todaydt  = todaydt + datetime.timedelta(days = -bdays)
-        todays   = todaydt.strftime("%Y-%m-%d")
-        query    = "after:%s before:%s" % (todays, tomorrow)
+        self.metrics = run_metrics(self.account)
+        self.att_budget = att_budget(self.att_run, self.att_thread)
+        if otype is None:
+            otype = self.cfg_args.otype
 
-        # Query today's message; if no messages, return None
-        todaym = self.messages.list(userId = 'me', q = query,
-                                    maxResults = 1000).execute()
-        if not todaym:
-            return None
+        if ext is None:
+            ext = self.cfg_args.ext
 
-        # Loop through all messages; get message body and attachments
-        msg_ids  = set([ids['id'] for ids in todaym['messages']])
-        all_msgs = [self.get_msg(mid) for mid in msg_ids]
-        thr_ids  = [msg['threadId'] for msg in all_msgs]
-        atts     = [self.parse_att(msg, msize) for msg in all_msgs]
-        parsed   = [self.parse_msg(msg, otype) for msg in all_msgs]
-
-        # Return messages as pandas data frame
-        cols  = ['threadId',
-                 'body',
-                 'ft_header',
-                 'header',
-                 'date',
-                 'subject',
-                 'fn',
-                 'att']
-        dtzip = zip(thr_ids, parsed, atts)
-        dfstr = '%Y-%m-%d %H:%M:%S ' + self.tzstr
-        dt    = [[thr] + pmsg + att for thr, pmsg, att in dtzip]
-        df    = pd.DataFrame(dt, index = msg_ids, columns = cols)
-
-        # Parse string dates as datetime
-        df['dtf'] = df['date'].apply(lambda d: d.strftime(dfstr))
-        df.sort_values(by = ['threadId', 'dtf'],
-                       inplace = True,
-                       ascending = [True, not first])
-
-        return df
-
-    def sort_query(self, sort_rules, case):
-        """Sort queried e-mail into sub-folders using sort_rules
+        if att_get is None:
+            att_get = self.cfg_args.att_get
 
-        Args:
-            sort_rules: JSON file with rules.
+        if att_max is None:
+            att_max = self.cfg_args.att_max
 
-        Returns:
-            Each key in sort_rules is a sub-folder within outdir. The
-            program recursively searches all e-mail threads in outdir
-            for files within each thread matching a rule.
+        if mail is None:
+            mail = self.cfg_args.mail
 
-            If a file in the thread matches any of the keys' rules, it
-            moves it to outdir/key. If it matches no rules, it is moved
-            to outdir/unsorted.
+        if first is None:
+            first = self.cfg_args.first
 
-            The search is applied in order using each key's priority.
-            Keys with equal priority are applied in arbitrary order.
-        """
+        if sort_case is None:
+            sort_case = self.cfg_args.sort_case
 
-        outdir  = self.finaldir
-        srules  = json.load(open(sort_rules))
-        outwalk = os.walk(outdir)
+        if sort_rules is None:
+            sort_rules = self.cfg_args.sort_file
 
-        outwalk_static = []
-        for root, dirs, files in outwalk:
-            outwalk_static += [[root, dirs, files]]
+        ptypes = output_types(self.renderer, otype, self.metrics)
+        if otype not in ptypes and not otype == 'eml':
+            raise Warning("Output type must be: {}".format(', '.join(ptypes)))
 
-        unsorted = mkdir_recursive(os.path.join(outdir, "unsorted"))
-        for root, dirs, files in outwalk_static:
-            if len(files) > 0:
-                for fname in files:
-                    if apply_rules(srules,
-                                   outdir,
-                                   root,
-                                   fname,
-                                   case) in srules.keys():
-                        break
+        max_size = parse_string(att_max) if att_get else None
+        ext      = ext_dict[otype] if ext == '' else ext
+        options  = render_options(otype, ext, max_size, first,
+                                  self.att_budget, self.renderer,
+                                  self.raw_max)
+        days     = date_range(start, end)
+        window   = (day_window(days[0], self.timezone)[0],
+                    day_window(days[-1], self.timezone)[1])
+        claimed  = thread_claims()
+
+        def run_day(day):
+            try:
+                after, before = day_window(day, self.timezone)
+                ids = self.list_shard(after, before,
+                                      threads = self.fetch_threads)
+                if self.fetch_threads:
+                    # A thread spanning several days is got once, by the
+                    # first day that lists it, and its messages in the
+                    # backfill go to their own days
+                    df = self.query_threads(claimed.claim(ids), first, otype,
+                                            max_size, options, window)
+                else:
+                    df = self.query_ids(ids, first, otype, max_size, options)
+            except:
+                return "%s: Gmail query FAILED" % day
 
-                if os.path.isdir(root):
-                    move(root, unsorted)
+            if df is None:
+                return "%s: No new e-mail" % day
 
-    def parse_att(self, msg, msize, depth = 10):
-        """Get all attachments in message thread
+            self.write_days(df, otype, ext, sort_rules, sort_case, options)
+            return "%s: %d messages" % (day, len(df))
 
-        Args:
-            msg: gmail msg
+        shard_pool = ThreadPool(max(1, min(shards, len(days))))
+        try:
+            res = shard_pool.map(run_day, days)
+        finally:
+            shard_pool.close()
+
+        self.manifest.save(compact = True)
+        self.flush_export()
+        self.notify("Mail Backfill for %s to %s" % (start, end),
+                    os.linesep.join(res), mail)
+
+    def watch(self,
+              interval = None,
+              otype    = None,
+              ext      = None,
+              att_get  = None,
+              att_max  = None,
+              first    = None,
+              sort_case  = None,
+              sort_rules = None,
+              overlap    = 300,
+              attempts   = 3,
+              stop       = None):
+
+        """Poll Gmail for new e-mail until stopped
+
+        Kwargs:
+            interval: Seconds between polls (default from config)
+            overlap: Each poll looks this many seconds before the last
+                one, to catch messages Gmail indexes late. Messages
+                already written are skipped.
+            attempts: Polls that retry a message that fails to download,
+                parse or write before it is skipped
+            stop: threading.Event that ends the loop after the current
+                poll (default: one set by SIGINT and SIGTERM, see
+                stop_on_signals)
+
+        Returns:
+            New messages are written to outdir/<day they arrived> (and
+            sorted) as they come in. The poll position, recently
+            written ids and failed ids (with their attempts) are kept in
+            outdir/.gmail_query_watch.json, so a restart picks up where
+            the last run stopped. A message that fails does not hold up
+            the others. SIGINT and SIGTERM stop the loop after the
+            current poll.
+        """
+
+        if interval is None:
+            interval = self.cfg_args.interval
+
+        if otype is None:
+            otype = self.cfg_args.otype
+
+        if ext is None:
+            ext = self.cfg_args.ext
+
+        if att_get is None:
+            att_get = self.cfg_args.att_get
+
+        if att_max is None:
+            att_max = self.cfg_args.att_max
+
+        if first is None:
+            first = self.cfg_args.first
+
+        if sort_case is None:
+            sort_case = self.cfg_args.sort_case
+
+        if sort_rules is None:
+            sort_rules = self.cfg_args.sort_file
+
+        ptypes = output_types(self.renderer, otype, self.metrics)
+        if otype not in ptypes and not otype == 'eml':
+            raise Warning("Output type must be: {}".format(', '.join(ptypes)))
+
+        max_size = parse_string(att_max) if att_get else None
+        ext      = ext_dict[otype] if ext == '' else ext
+        options  = render_options(otype, ext, max_size, first,
+                                  self.att_budget, self.renderer,
+                                  self.raw_max)
+
+        # Resume from the last poll (or from midnight today)
+        # --------------------------------------------------
+
+        mkdir_recursive(self.outdir)
+        state_file = os.path.join(self.outdir, '.gmail_query_watch.json')
+        try:
+            state = json.load(open(state_file))
+        except:
+            today = str(datetime.date.today())
+            state = {'after': day_window(today, self.timezone)[0],
+                     'seen':  {}}
+
+        def flush():
+            with open(state_file + '.tmp', 'w') as fout:
+                json.dump(state, fout)
+
+            os.rename(state_file + '.tmp', state_file)
+
+        if stop is None:
+            stop = threading.Event()
+            try:
+                stop_on_signals(stop)
+            except ValueError:
+                pass  # Not in the main thread; stop with KeyboardInterrupt
+
+        compacted = time.time()
+        try:
+            while not stop.is_set():
+                self.att_budget = att_budget(self.att_run, self.att_thread)
+                now   = int(time.time())
+                query = "after:%d" % (state['after'] - overlap)
+                try:
+                    msg_ids = self.list_ids(query)
+                except Exception as e:
+                    print("Gmail query FAILED: {}".format(e))
+                    stop.wait(interval)
+                    continue
+
+                # Messages that failed before are retried wherever they are
+                failed  = state.setdefault('failed', {})
+                new_ids = [mid for mid in msg_ids
+                           if mid not in state['seen'] and mid not in failed]
+                new_ids = list(failed) + new_ids
+
+                failing = set()
+                def fail(mid, e):
+                    failing.add(mid)
+                    failed[mid] = failed.get(mid, 0) + 1
+                    self.metrics.count('messages_failed')
+                    print("Message %s FAILED (%d of %d): %s" %
+                          (mid, failed[mid], attempts, e))
+                    if failed[mid] >= attempts:
+                        del failed[mid]  # Skipped from now on
+
+                try:
+                    dfs = [self.query_ids(new_ids, first, otype, max_size,
+                                          options)]
+                except Exception:
+                    # One bad message fails the batch; go one at a time
+                    dfs = []
+                    for mid in new_ids:
+                        try:
+                            dfs += [self.query_ids([mid], first, otype,
+                                                   max_size, options)]
+                        except Exception as e:
+                            fail(mid, e)
+
+                written = []
+                for df in [df for df in dfs if df is not None]:
+                    try:
+                        self.write_days(df, otype, ext, sort_rules,
+                                        sort_case, options)
+                        written += list(df.index)
+                        continue
+                    except Exception:
+                        pass
+
+                    # As above, one message at a time
+                    for mid in df.index:
+                        try:
+                            self.write_days(df.loc[[mid]], otype, ext,
+                                            sort_rules, sort_case, options)
+                            written += [mid]
+                        except Exception as e:
+                            fail(mid, e)
+
+                # A message's failures are forgotten once it gets through
+                for mid in set(new_ids) - failing:
+                    failed.pop(mid, None)
+
+                if written:
+                    print("%d new messages" % len(written))
+
+                # Only ids within the overlap window can be listed again
+                state['seen'].update(dict((mid, now) for mid in new_ids
+                                          if mid not in failed))
+                state['seen'] = dict((mid, seen)
+                                     for mid, seen in state['seen'].items()
+                                     if seen > now - 2 * overlap - interval)
+                state['after'] = now
+                flush()
+                self.flush_export(3600)
+                # Keep the manifest and thread index current while watching
+                if now - compacted >= 3600:
+                    self.manifest.save(compact = True)
+                    compacted = now
+
+                self.report_metrics()
+                stop.wait(interval)
+        finally:
+            flush()
+            self.manifest.save(compact = True)
+            self.flush_export()
+
+    def plan(self,
+             todays  = None,
+             bdays   = None,
+             start   = None,
+             end     = None,
+             otype   = None,
+             ext     = None,
+             att_get = None,
+             att_max = None,
+             mail    = None,
+             first   = None):
+
+        """Estimate what query (or backfill) would download, write nothing
+
+        The window is listed as the query would list it, and every
+        message not yet in the output manifest is got with plan_fields
+        as field mask (part sizes, no data; whole threads in thread
+        mode), so the plan itself costs about as many requests as the
+        query minus the attachments.
+
+        Kwargs:
+            todays: Date to query (e.g. 2016-01-01; default today)
+            bdays: Days back to look for e-mail.
+            start: First day of a backfill (with end, instead of todays)
+            end: Last day of a backfill (inclusive)
+
+        Returns:
+            Dictionary with the estimates, also printed: messages and
+            threads to get, messages already written, body bytes,
+            attachment counts and bytes within and above att_max,
+            attachments to download (within the attachment budget),
+            quota units, requests, and run seconds projected from the
+            quota rate and from the plan's own request latency at the
+            configured workers.
+        """
+
+        self.metrics = run_metrics(self.account)
+        if bdays is None:
+            bdays = self.cfg_args.bdays
+
+        if otype is None:
+            otype = self.cfg_args.otype
+
+        if ext is None:
+            ext = self.cfg_args.ext
+
+        if att_get is None:
+            att_get = self.cfg_args.att_get
+
+        if att_max is None:
+            att_max = self.cfg_args.att_max
+
+        if mail is None:
+            mail = self.cfg_args.mail
+
+        if first is None:
+            first = self.cfg_args.first
+
+        ptypes = output_types(self.renderer, otype, self.metrics)
+        if otype not in ptypes and not otype == 'eml':
+            raise Warning("Output type must be: {}".format(', '.join(ptypes)))
+
+        max_size = parse_string(att_max)
+        ext      = ext_dict[otype] if ext == '' else ext
+        budget   = att_budget(self.att_run, self.att_thread)
+        options  = render_options(otype, ext, max_size if att_get else None,
+                                  first, budget, self.renderer,
+                                  self.raw_max)
+
+        # List the window and get sizes of the messages not yet written
+        # --------------------------------------------------------------
+
+        span = None
+        if start is not None:
+            window = "%s to %s" % (start, end)
+            span   = (day_window(start, self.timezone)[0],
+                      day_window(end, self.timezone)[1])
+            ids    = self.list_shard(span[0], span[1],
+                                     threads = self.fetch_threads)
+        else:
+            todays = todays if todays else str(datetime.date.today())
+            window = "%s (%d days back)" % (todays, bdays)
+            ids    = self.list_ids(todays_query(todays, bdays),
+                                   threads = self.fetch_threads)
+
+        ids = list(set(ids))
+        if self.fetch_threads:
+            kind     = 'threads'
+            threads  = self.pool.map(lambda thr: self.get_meta(thr, True), ids)
+            all_msgs = [msg for thread in threads
+                        for msg in thread.get('messages', [])]
+            if span is not None:
+                # Backfills only write the messages within the range
+                all_msgs = [msg for msg in all_msgs
+                            if 'internalDate' not in msg or span[0] * 1000 <=
+                            int(msg['internalDate']) < span[1] * 1000]
+
+            new_ids  = set(self.manifest.missing([msg['id'] for msg in all_msgs],
+                                                 options))
+            msgs     = [msg for msg in all_msgs if msg['id'] in new_ids]
+            skipped  = len(all_msgs) - len(msgs)
+            gets     = len(set(msg['threadId'] for msg in msgs))
+        else:
+            kind     = 'messages'
+            new_ids  = self.manifest.missing(ids, options)
+            msgs     = self.pool.map(self.get_meta, new_ids)
+            skipped  = len(ids) - len(new_ids)
+            gets     = len(msgs)
+
+        with self.metrics.stage('mime_walk'):
+            indexes = [index_parts(msg['payload']) for msg in msgs]
+
+        sizes  = [att['size'] for index in indexes
+                  for att in index['attachments']]
+        within = [size for size in sizes if size < max_size.bytes]
+        above  = [size for size in sizes if size >= max_size.bytes]
+
+        # Inline attachments come with the message; only ids are got
+        jobs = []
+        if att_get:
+            jobs = [(size, i, j) for size, i, j in
+                    budget.plan(msgs, indexes, max_size)[0]
+                    if indexes[i]['attachments'][j]['attachmentId']]
+
+        # Quota and run time
+        # ------------------
+
+        stages  = self.metrics.report()['stages']
+        latency = lambda name: stages[name]['seconds'] / stages[name]['calls'] \
+            if name in stages else 0
+
+        pages    = stages['list']['calls']
+        units    = pages * quota_units[kind + '.list'] + \
+            gets * quota_units[kind + '.get'] + \
+            len(jobs) * quota_units['messages.attachments.get'] + \
+            (quota_units['messages.insert'] if mail else 0)
+        requests = pages + gets + len(jobs) + (1 if mail else 0)
+        seconds  = max(units / self.budget.rate,
+                       pages * latency('list') +
+                       (gets + len(jobs)) * latency('get_meta') / self.workers)
+
+        plan = {'window':             window,
+                'messages':           len(msgs),
+                'messages_skipped':   skipped,
+                'threads':            len(set(msg['threadId'] for msg in msgs)),
+                'body_bytes':         sum(body_size(msg['payload'])
+                                          for msg in msgs),
+                'attachments_within': len(within),
+                'attachment_bytes_within': sum(within),
+                'attachments_above':  len(above),
+                'attachment_bytes_above':  sum(above),
+                'attachments_get':    len(jobs),
+                'attachment_bytes_get':    sum(size for size, i, j in jobs),
+                'quota_units':        units,
+                'requests':           requests,
+                'seconds':            seconds,
+                'plan_quota_units':   self.metrics.counters.get('quota_units', 0)}
+
+        fmt   = lambda nbytes: bytes_bm(nbytes).format('{value:.1f} {unit}')
+        lines = ["Plan for %s" % window,
+                 "%-18s %d (%d already written)" %
+                 ('Messages', plan['messages'], skipped),
+                 "%-18s %d" % ('Threads', plan['threads']),
+                 "%-18s %s" % ('Body bytes', fmt(plan['body_bytes'])),
+                 "%-18s %d within %s (%s), %d above (%s)" %
+                 ('Attachments', len(within), fmt(max_size.bytes),
+                  fmt(sum(within)), len(above), fmt(sum(above))),
+                 "%-18s %d (%s)" %
+                 ('Attachment gets', len(jobs),
+                  fmt(plan['attachment_bytes_get'])),
+                 "%-18s %d in %d requests (the plan spent %d)" %
+                 ('Quota units', units, requests, plan['plan_quota_units']),
+                 "%-18s %.0fs at %d workers and %g units/s" %
+                 ('Projected run', seconds, self.workers, self.budget.rate)]
+
+        print(os.linesep.join(lines))
+        return plan
+
+    def enqueue(self, start, end, queue, mail = None, batch = 200, shards = 4):
+        """Queue every day from start to end for worker processes
+
+        Args:
+            start: First day to queue (e.g. 2016-01-01)
+            end: Last day to queue (inclusive)
+            queue: work_queue object
+
+        Kwargs:
+            batch: Most messages (threads in thread mode) in a task. The
+                messages of a thread on the same day stay in one task,
+                so they end up in one thread folder.
+            shards: Number of days listed at the same time
+
+        Returns:
+            Each day is listed as backfill lists it, and its message (or
+            thread) ids are added to queue as pending tasks named
+            <day>-<n>. Any number of `work` processes then write them.
+        """
+
+        self.metrics = run_metrics(self.account)
+        if mail is None:
+            mail = self.cfg_args.mail
+
+        kind    = 'threads' if self.fetch_threads else 'messages'
+        days    = date_range(start, end)
+        window  = [day_window(days[0], self.timezone)[0],
+                   day_window(days[-1], self.timezone)[1]]
+        claimed = thread_claims()
+
+        def queue_day(day):
+            try:
+                after, before = day_window(day, self.timezone)
+                if self.fetch_threads:
+                    # As in backfill, a thread is queued once (see work)
+                    groups = [[thr_id] for thr_id in claimed.claim(
+                        self.list_shard(after, before, threads = True))]
+                else:
+                    groups = {}
+                    for entry in self.list_shard(after, before, entries = True):
+                        groups.setdefault(entry['threadId'], []).append(entry['id'])
+
+                    groups = [groups[thr_id] for thr_id in sorted(groups)]
+            except:
+                return "%s: Gmail query FAILED" % day
+
+            tasks = []
+            for ids in groups:
+                if not tasks or (tasks[-1] and len(tasks[-1]) + len(ids) > batch):
+                    tasks += [[]]
+
+                tasks[-1] += ids
+
+            for n, ids in enumerate(tasks):
+                queue.put('%s-%05d' % (day, n), {'day':     day,
+                                                 'ids':     ids,
+                                                 'threads': self.fetch_threads,
+                                                 'window':  window})
+
+            return "%s: %d tasks, %d %s" % (day, len(tasks),
+                                            sum(map(len, tasks)), kind)
+
+        shard_pool = ThreadPool(max(1, min(shards, len(days))))
+        try:
+            res = shard_pool.map(queue_day, days)
+        finally:
+            shard_pool.close()
+
+        counts = queue.counts()
+        res   += ["Queue: " + ', '.join('%d %s' % (counts[state], state)
+                                        for state in queue.states)]
+        self.notify("Mail Queue for %s to %s" % (start, end),
+                    os.linesep.join(res), mail)
+
+    def work(self,
+             queue,
+             otype   = None,
+             ext     = None,
+             att_get = None,
+             att_max = None,
+             mail    = None,
+             first   = None,
+             sort_case  = None,
+             sort_rules = None):
+
+        """Write tasks from queue until there are none left
+
+        Args:
+            queue: work_queue object (see enqueue)
+
+        Returns:
+            Tasks are claimed one at a time and written to outdir/<day>
+            exactly as backfill writes a day, renewing the lease while
+            they run. When no task is pending but other workers still
+            hold leases, the worker waits, since a lease that runs out
+            goes back to pending. Failed tasks are retried (see
+            work_queue.fail). Run workers with the same output options;
+            they share the output manifest and thread index.
+        """
+
+        self.metrics = run_metrics(self.account)
+        self.att_budget = att_budget(self.att_run, self.att_thread)
+        if otype is None:
+            otype = self.cfg_args.otype
+
+        if ext is None:
+            ext = self.cfg_args.ext
+
+        if att_get is None:
+            att_get = self.cfg_args.att_get
+
+        if att_max is None:
+            att_max = self.cfg_args.att_max
+
+        if mail is None:
+            mail = self.cfg_args.mail
+
+        if first is None:
+            first = self.cfg_args.first
+
+        if sort_case is None:
+            sort_case = self.cfg_args.sort_case
+
+        if sort_rules is None:
+            sort_rules = self.cfg_args.sort_file
+
+        ptypes = output_types(self.renderer, otype, self.metrics)
+        if otype not in ptypes and not otype == 'eml':
+            raise Warning("Output type must be: {}".format(', '.join(ptypes)))
+
+        max_size = parse_string(att_max) if att_get else None
+        ext      = ext_dict[otype] if ext == '' else ext
+        options  = render_options(otype, ext, max_size, first,
+                                  self.att_budget, self.renderer,
+                                  self.raw_max)
+
+        done   = 0
+        failed = []
+        while True:
+            claimed = queue.claim()
+            if claimed is None:
+                if not queue.tasks('leased'):
+                    break
+
+                time.sleep(min(queue.lease / 4, 30))
+                continue
+
+            name, task = claimed
+            with queue.held(name):
+                try:
+                    # A thread's messages in the queued range go to their
+                    # own days
+                    if task['threads']:
+                        df = self.query_threads(task['ids'], first, otype,
+                                                max_size, options,
+                                                task.get('window'))
+                    else:
+                        df = self.query_ids(task['ids'], first, otype,
+                                            max_size, options)
+
+                    if df is not None:
+                        self.write_days(df, otype, ext, sort_rules,
+                                        sort_case, options)
+                except Exception as e:
+                    queue.fail(name, task, repr(e))
+                    if name[:-5] not in failed:
+                        failed += [name[:-5]]
+
+                    continue
+
+            # A task whose lease ran out was reclaimed by another worker,
+            # which counts it
+            if queue.done(name):
+                done += 1
+
+        res = "%d tasks written, %d failed (see %s)" % (done, len(failed),
+                                                      queue.folder)
+        if failed:
+            res += ":" + os.linesep + os.linesep.join(failed)
+
+        self.manifest.save(compact = True)
+        self.flush_export()
+        self.notify("Mail Queue Worker", res, mail)
+
+    def write_days(self, df, otype, ext, sort_rules, sort_case, options):
+        """write_query each day's messages of df to outdir/<day>"""
+
+        days = df['date'].apply(lambda d: d.strftime("%Y-%m-%d"))
+        for day in days.unique():
+            self.write_query(df.loc[days == day],
+                             os.path.join(self.outdir, day),
+                             otype, ext, sort_rules, sort_case, options)
+
+    def write_query(self, df, outdir, otype, ext, sort_rules, sort_case,
+                    options = None):
+        """Print queried e-mail into outdir and sort it
+
+        New threads are sorted; messages of threads already in the
+        output manifest go to their existing folder. The manifest is
+        saved once the thread folders are in place.
+        """
+
+        with self.metrics.stage('write'):
+            folders = print_df_query(df, outdir, self.tzstr, otype, ext,
+                                     self.metrics, self.writer,
+                                     self.manifest, options, self.layout)
+
+        self.metrics.count('messages', len(df))
+        self.metrics.count('threads', df['threadId'].nunique())
+        if sort_rules != '' and folders:
+            if os.path.isfile(sort_rules):
+                try:
+                    with self.metrics.stage('sort'):
+                        moved = self.sort_query(sort_rules, sort_case,
+                                                outdir, folders)
+                        self.manifest.move(moved)
+                except:
+                    print("Sorting failed. Check '{}'".format(sort_rules))
+            else:
+                print("'{}' not found. Can't sort.".format(sort_rules))
+
+        if self.export is not None:
+            try:
+                keys = list(json.load(open(sort_rules))) + ['unsorted']
+            except (IOError, ValueError):
+                keys = []
+
+            self.export.add(df, self.manifest, keys)
+
+        self.manifest.save()
+
+    def flush_export(self, age = 0):
+        """Write the buffered Parquet rows (see parquet_export.flush)"""
+
+        if self.export is not None:
+            self.export.flush(age, self.metrics)
+
+    def notify(self, subject, res, mail):
+        """E-mail yourself res (or print it if mail is False)
+
+        The run's metrics are written out first (see report_metrics) and
+        appended to res if metrics_mail is set.
+        """
+
+        summary = self.report_metrics()
+        if self.metrics_mail:
+            res += os.linesep + os.linesep + summary
+
+        if mail:
+            msg = ["Content-Type: text/plain; charset=\"UTF-8\"",
+                   "MIME-Version: 1.0",
+                   "Content-Transfer-Encoding: message/rfc2822",
+                   "To: <%s>" % self.outmail,
+                   "From: <%s>" % self.outmail,
+                   "Subject: %s" % subject, "", res]
+
+            b = base64.urlsafe_b64encode(to_bytes(os.linesep.join(msg)))
+            b = b.decode('ascii')
+            self.execute(self.messages.insert(userId = 'me', body = {'raw': b}),
+                         quota_units['messages.insert'])
+        else:
+            print(res)
+
+    def report_metrics(self):
+        """Write the metrics report and Prometheus textfile, if set
+
+        Returns:
+            Plain text summary of the run's metrics
+        """
+
+        if self.metrics_report:
+            self.metrics.write_json(self.metrics_report)
+
+        if self.metrics_prom:
+            self.metrics.write_prom(self.metrics_prom)
+
+        return self.metrics.summary()
+
+    def query_todays(self, todays, bdays, first, otype, msize,
+                     options = None):
+        """Get all of today's messages
+
+        Args:
+            todays: Messages from date.
+            bdays: Days back to look for e-mail.
+
+        Kwargs:
+            options: Render options; skip messages already written with
+                them (see query_ids)
+
+        Returns:
+            df: Data frame with today's messages
+
+        """
+
+        # Query today's message; if no messages, return None
+        query = todays_query(todays, bdays)
+        if self.fetch_threads:
+            return self.query_threads(self.list_ids(query, threads = True),
+                                      first, otype, msize, options)
+
+        return self.query_ids(self.list_ids(query), first, otype, msize,
+                              options)
+
+    def query_ids(self, msg_ids, first, otype, msize, options = None):
+        """Get and parse messages by id
+
+        Args:
+            msg_ids: Message ids to download.
+
+        Kwargs:
+            options: Render options (see render_options). Messages the
+                output manifest has written with the same options, and
+                whose files still exist, are skipped.
+
+        Returns:
+            df: Data frame with the messages, or None if there are none
+        """
+
+        msg_ids = list(set(msg_ids))
+        if options is not None:
+            new_ids = self.manifest.missing(msg_ids, options)
+            self.metrics.count('messages_skipped', len(msg_ids) - len(new_ids))
+            msg_ids = new_ids
+
+        if not msg_ids:
+            return None
+
+        # Loop through all messages; get message body and attachments
+        return self.parse_msgs(self.pool.map(self.get_msg, msg_ids),
+                               first, otype, msize)
+
+    def query_threads(self, thr_ids, first, otype, msize, options = None,
+                      window = None):
+        """Get and parse whole threads by id
+
+        Each thread is one threads.get request (with thread_fields as
+        field mask) instead of one messages.get per message.
+
+        Args:
+            thr_ids: Thread ids to download.
+
+        Kwargs:
+            options: Render options (see query_ids). Messages of the
+                threads that were already written are skipped.
+            window: Only keep messages whose internalDate is within
+                [after, before) (epoch seconds)
+
+        Returns:
+            df: Data frame with the messages, or None if there are none
+        """
+
+        if not thr_ids:
+            return None
+
+        threads  = self.pool.map(self.get_thread, list(set(thr_ids)))
+        all_msgs = [msg for thread in threads
+                    for msg in thread.get('messages', [])]
+        if window is not None:
+            after, before = window[0] * 1000, window[1] * 1000
+            all_msgs = [msg for msg in all_msgs if 'internalDate' not in msg or
+                        after <= int(msg['internalDate']) < before]
+
+        if options is not None:
+            new_ids  = set(self.manifest.missing([msg['id'] for msg in all_msgs],
+                                                 options))
+            self.metrics.count('messages_skipped', len(all_msgs) - len(new_ids))
+            all_msgs = [msg for msg in all_msgs if msg['id'] in new_ids]
+
+        if not all_msgs:
+            return None
+
+        return self.parse_msgs(all_msgs, first, otype, msize)
+
+    def parse_msgs(self, all_msgs, first, otype, msize):
+        """Parse downloaded messages and get their attachments
+
+        Returns:
+            df: Data frame with the messages
+        """
+
+        msg_ids  = [msg['id'] for msg in all_msgs]
+        thr_ids  = [msg['threadId'] for msg in all_msgs]
+        with self.metrics.stage('mime_walk'):
+            indexes = [index_parts(msg['payload']) for msg in all_msgs]
+
+        with self.metrics.stage('dates'):
+            dates = local_dates([msg.get('internalDate') for msg in all_msgs],
+                                self.timezone)
+
+        # Attachments download in the background while bodies convert
+        fetcher  = ThreadPool(1)
+        try:
+            atts   = fetcher.apply_async(self.fetch_atts,
+                                         (all_msgs, indexes, msize))
+            parsed = self.pool.map(lambda mid: self.parse_msg(mid[0], otype,
+                                                              index = mid[1],
+                                                              date  = mid[2]),
+                                   list(zip(all_msgs, indexes, dates)))
+            atts   = atts.get()
+        finally:
+            fetcher.close()
+
+        return messages_df(msg_ids, thr_ids, parsed, atts, first)
+
+    def list_ids(self, query, token = None, threads = False, entries = False):
+        """List all message ids matching query, following every page
+
+        Args:
+            query: Gmail search query
+
+        Kwargs:
+            token: Page token to start from
+            threads: List thread ids (threads.list) instead
+            entries: List the page entries (message id and thread id
+                dictionaries) instead of ids
+
+        Returns:
+            List of message (or thread) ids
+        """
+
+        msg_ids = []
+        while True:
+            with self.metrics.stage('list'):
+                ids, token = self.list_page(query, token, threads, entries)
+
+            msg_ids += ids
+            if not token:
+                return msg_ids
+
+    def list_page(self, query, token = None, threads = False,
+                  entries = False):
+        """One messages.list (or threads.list) page
+
+        Returns:
+            ids: Message (or thread) ids on the page (the entries
+                themselves if entries is set)
+            token: Next page token (None on the last page)
+        """
+
+        kind = 'threads' if threads else 'messages'
+        res  = self.execute(getattr(self, kind).list(userId     = 'me',
+                                                     q          = query,
+                                                     maxResults = 500,
+                                                     pageToken  = token),
+                            quota_units[kind + '.list'])
+
+        ids  = res.get(kind, [])
+        ids  = ids if entries else [ids['id'] for ids in ids]
+        return ids, res.get('nextPageToken')
+
+    def list_shard(self, after, before, threads = False, entries = False):
+        """List message ids in [after, before), following every page
+
+        Args:
+            after: Window start, epoch seconds
+            before: Window end, epoch seconds
+
+        Kwargs:
+            threads: List thread ids instead
+            entries: List message entries (id and threadId) instead of
+                message ids
+
+        Returns:
+            List of message ids. Pages follow each other's tokens, so a
+            window is listed in order; backfills get their concurrency
+            from listing several days at once.
+        """
+
+        query = "after:%d before:%d" % (after, before)
+        return self.list_ids(query, threads = threads, entries = entries)
+
+    def sort_query(self, sort_rules, case, outdir = None, folders = None):
+        """Sort queried e-mail into sub-folders using sort_rules
+
+        Args:
+            sort_rules: JSON file with rules.
+
+        Kwargs:
+            outdir: Folder to sort (default is the last queried folder).
+            folders: Only sort these thread folders within outdir
+                (default is everything in outdir).
+
+        Returns:
+            Each key in sort_rules is a sub-folder within outdir. The
+            program recursively searches all e-mail threads in outdir
+            for files within each thread matching a rule.
+
+            If a file in the thread matches any of the keys' rules, it
+            moves it to outdir/key. If it matches no rules, it is moved
+            to outdir/unsorted. With a sharded layout, folders keep
+            their shard (outdir/key/<shard>).
+
+            The search is applied in order using each key's priority.
+            Keys with equal priority are applied in arbitrary order.
+
+            Returns a dictionary of each folder moved -> its new path.
+        """
+
+        outdir  = self.finaldir if outdir is None else outdir
+        srules  = json.load(open(sort_rules))
+        folders = [outdir] if folders is None else folders
+
+        outwalk_static = []
+        for folder in folders:
+            for root, dirs, files in os.walk(folder):
+                outwalk_static += [[root, dirs, files]]
+
+        moved    = {}
+        unsorted = os.path.join(outdir, "unsorted")
+        mkdir_recursive(unsorted)
+        for root, dirs, files in outwalk_static:
+            if len(files) > 0:
+                shard = ''
+                if self.layout != 'flat':
+                    shard = os.path.relpath(os.path.dirname(root), outdir)
+                    shard = '' if shard == os.curdir else shard
+
+                for fname in files:
+                    key = apply_rules(srules, outdir, root, fname, case, shard)
+                    if key in srules.keys():
+                        moved[root] = os.path.join(outdir, key, shard,
+                                                   os.path.basename(root))
+                        break
+
+                if os.path.isdir(root):
+                    mkdir_recursive(os.path.join(unsorted, shard))
+                    move(root, os.path.join(unsorted, shard))
+                    moved[root] = os.path.join(unsorted, shard,
+                                               os.path.basename(root))
+
+                if shard:
+                    try:
+                        os.rmdir(os.path.dirname(root))
+                    except OSError:
+                        pass  # Shard still has unsorted thread folders
+
+        return moved
+
+    def parse_att(self, msg, msize, index = None):
+        """Get all attachments in message
+
+        Args:
+            msg: gmail msg
+            msize: A bitmath object with max size
+
+        Kwargs:
+            index: index_parts(msg['payload']), if already built
+
+        Returns:
+            List of attachment file names, list of their data
+            (attachments over msize or the attachment budget are
+            replaced by a note) and list of their sizes
+
+        """
+
+        if index is None:
+            with self.metrics.stage('mime_walk'):
+                index = index_parts(msg['payload'])
+
+        return self.fetch_atts([msg], [index], msize)[0]
+
+    def fetch_atts(self, msgs, indexes, msize):
+        """Get the attachments of msgs within the attachment budget
+
+        Args:
+            msgs: gmail msgs
+            indexes: index_parts(msg['payload']) of each message
+            msize: A bitmath object with max size
+
+        Returns:
+            parse_att output for each message. Attachments are planned
+            from the sizes in the index (see att_budget.plan) and
+            downloaded smallest first.
+        """
+
+        if msize is None:
+            return [[[], [], []] for msg in msgs]
+
+        jobs, notes = self.att_budget.plan(msgs, indexes, msize)
+        self.metrics.count('attachments_skipped', len(notes))
+
+        def fetch(job):
+            size, i, j = job
+            att_id = indexes[i]['attachments'][j]['attachmentId']
+            return self.get_att(msgs[i]['id'], att_id)['data']
+
+        data    = self.pool.map(fetch, jobs)
+        fetched = dict(((i, j), d) for (size, i, j), d in zip(jobs, data))
+        return collect_atts(indexes, notes, fetched)
+
+    def parse_msg(self, msg, otype, prefer = 'text/html', index = None,
+                  date = None):
+        """Get body from message, various formats
+
+        Args:
+            message: dictionary with message info from Gmail API
+
+        Kwargs:
+            prefer: prefer this type
+            index: index_parts(msg['payload']), if already built
+            date: Local date of msg['internalDate'], if already converted
+                (see local_dates)
+
+        Returns: Plain text e-mail exchange: formatted body and header,
+            plain header, local date, subject, from, to, cc, the body's
+            content type and the epoch milliseconds the date is from.
+            The date is when Gmail received the message (internalDate);
+            the Date header is only parsed if a message has none.
+        """
+
+        types = ['text/html', 'text/plain']
+        if prefer not in types:
+            raise Warning("Can only search for text/plain or text/html.")
+
+        # Find the message body
+        if index is None:
+            with self.metrics.stage('mime_walk'):
+                index = index_parts(msg['payload'])
+
+        texts = [p for p in [index['body']] + index['alternates'] if p]
+        found = len(texts) > 0
+        try:
+            p = texts[0]
+            for part in texts:
+                if part['mimeType'] == prefer:
+                    p = part
+                    break
+
+            pmime = p['mimeType']
+            body  = p['body']['data']
+            plain = base64.urlsafe_b64decode(unicode(body).encode('utf-8'))
+        except:
+            pmime = 'text/plain'
+            plain = 'Message body could not be retrieved.'
+
+        # Bodies over raw_max are written as received, which bounds the
+        # time any one message spends in stripping and conversion
+        raw = self.raw_max is not None and len(plain) > self.raw_max
+
+        # Inline data and CSS don't survive conversion; drop them first
+        if pmime == 'text/html' and not raw:
+            with self.metrics.stage('strip'):
+                plain, stripped = strip_html(plain)
+
+            self.metrics.count('bytes_stripped', stripped)
+
+        if found and pmime != prefer:
+            msg_type = 'Could not find preferred type. Body retrieved as %s.'
+            print(msg_type % pmime)
+
+        # Get headers
+        head = msg_headers(msg['payload'])
+        fr   = head.get('from', 'Unknown')
+        to   = head.get('to', 'Unknown')
+        cc   = head.get('cc')
+        sub  = head.get('subject', 'Unknown')
+
+        # Get message date
+        stamp = msg.get('internalDate')
+        datel = date
+        if datel is None and stamp is not None:
+            datel = local_dates([stamp], self.timezone)[0]
+        elif datel is None:
+            try:
+                dateu = parse(head['date'])
+            except:
+                dateu = datetime.datetime.now(self.timezone)
+
+            try:
+                datel = dateu.astimezone(self.timezone)
+            except:
+                datel = dateu.replace(tzinfo = self.timezone)
+
+        if stamp is None:
+            stamp = calendar.timegm(datel.utctimetuple()) * 1000
+
+        dates = datel.strftime('%a, %d %b %Y %H:%M:%S ' + self.tzstr)
+
+        # Format headers
+        ctype = 'html' if otype == 'eml' else otype
+        head  = ['**From:** ' + fr,
+                 '**To:** ' + to,
+                 '**Cc:** ' + cc if cc else cc,
+                 '**Subject:** ' + sub,
+                 '**Date:** ' + dates,
+                 '**Id:** ' + msg['id'],
+                 '**Content-type:** ' + pmime]
+
+        md_head    = ('  ' + os.linesep).join(filter(None, head))
+        plain_head = os.linesep.join(filter(None, head)).replace('*', '')
+
+        if raw:
+            self.metrics.count('bodies_raw')
+            ft_body = plain.decode('utf-8', 'replace') \
+                if isinstance(plain, bytes) else plain
+
+        if native_render(self.renderer, otype):
+            with self.metrics.stage('render'):
+                ft_head = render_head(head, ctype)
+                if not raw:
+                    ft_body = render_body(plain, ctype, pmime)
+        else:
+            with self.metrics.stage('pandoc'):
+                ft_head = pandoc.convert_text(md_head, ctype, format = 'markdown')
+                if not raw:
+                    ft_body = pandoc.convert_text(plain, ctype,
+                                                  format     = 'html',
+                                                  extra_args = ['--smart'])
+
+        return [ft_body, ft_head, plain_head, datel, sub, fr, to,
+                cc if cc else '', pmime, int(stamp)]
+
+    def get_msg(self, msg_id):
+        with self.metrics.stage('get_msg'):
+            msg = self.execute(self.messages.get(userId = 'me',
+                                                 id     = msg_id,
+                                                 format = 'full',
+                                                 fields = msg_fields),
+                               quota_units['messages.get'])
+
+        self.metrics.count('bytes_downloaded', msg.get('sizeEstimate', 0))
+        return msg
+
+    def get_thread(self, thr_id):
+        with self.metrics.stage('get_thread'):
+            thread = self.execute(self.threads.get(userId = 'me',
+                                                   id     = thr_id,
+                                                   format = 'full',
+                                                   fields = thread_fields),
+                                  quota_units['threads.get'])
+
+        for msg in thread.get('messages', []):
+            self.metrics.count('bytes_downloaded', msg.get('sizeEstimate', 0))
+
+        return thread
+
+    def get_meta(self, item_id, thread = False):
+        """Message (or thread) with part sizes and no data, for plan
+
+        A message whose parts reach plan_depth may have deeper parts the
+        mask cut off; it is got again in full (with its data), which
+        the run metrics count as plan_unmasked.
+        """
+
+        kind   = 'threads' if thread else 'messages'
+        fields = 'id,messages(%s)' % plan_fields if thread else plan_fields
+        with self.metrics.stage('get_meta'):
+            item = self.execute(getattr(self, kind).get(userId = 'me',
+                                                        id     = item_id,
+                                                        format = 'full',
+                                                        fields = fields),
+                                quota_units[kind + '.get'])
+
+        msgs = item.get('messages', []) if thread else [item]
+        for k, msg in enumerate(msgs):
+            if part_depth(msg.get('payload') or {}) < plan_depth:
+                continue
+
+            self.metrics.count('plan_unmasked')
+            with self.metrics.stage('get_meta'):
+                msgs[k] = self.execute(self.messages.get(userId = 'me',
+                                                         id     = msg['id'],
+                                                         format = 'full',
+                                                         fields = msg_fields),
+                                       quota_units['messages.get'])
+
+        return item if thread else msgs[0]
+
+    def get_att(self, msg_id, att_id):
+        with self.metrics.stage('get_att'):
+            att = self.execute(self.messages.attachments().get(userId = 'me',
+                                                               messageId = msg_id,
+                                                               id = att_id),
+                               quota_units['messages.attachments.get'])
+
+        self.metrics.count('bytes_downloaded', att.get('size', 0))
+        return att
+
+    def http(self):
+        """Authorized connection for the current thread"""
+
+        try:
+            return self.local.http
+        except AttributeError:
+            self.local.http = httplib2.Http()
+            if self.credentials is not None:
+                self.credentials.authorize(self.local.http)
+
+            return self.local.http
+
+    def execute(self, request, units, retries = 5):
+        """Execute request within the request budget
+
+        Args:
+            request: Gmail API request
+            units: Quota units the request costs
+
+        Kwargs:
+            retries: Times to retry rate-limited or failed requests,
+                with exponential backoff.
+
+        Returns:
+            Request response
+        """
+
+        for attempt in range(retries + 1):
+            self.budget.acquire(units)
+            self.metrics.count('requests')
+            self.metrics.count('quota_units', units)
+            try:
+                with self.budget.workers:
+                    return request.execute(http = self.http())
+            except HttpError as e:
+                if e.resp.status not in [429, 500, 503] or attempt == retries:
+                    self.metrics.count('errors')
+                    raise
+
+            self.metrics.count('retries')
+            time.sleep(2 ** attempt + random.random())
+
+class run_metrics():
+
+    """Wall time, call counts, counters and latency histograms by stage
+
+    Stages are timed with `with metrics.stage('name'):`. Stage seconds
+    add up the time spent in every thread, so with several workers they
+    can exceed the run's wall time (reported as `seconds`).
+    """
+
+    buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self, account = None):
+        self.account  = account
+        self.lock     = threading.Lock()
+        self.started  = time.time()
+        self.stages   = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one call of stage name"""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = {'calls':   0,
+                                     'seconds': 0,
+                                     'max':     0,
+                                     'buckets': [0] * len(self.buckets)}
+
+            stage = self.stages[name]
+            stage['calls']   += 1
+            stage['seconds'] += seconds
+            stage['max']      = max(stage['max'], seconds)
+            for i, le in enumerate(self.buckets):
+                if seconds <= le:
+                    stage['buckets'][i] += 1
+
+    def count(self, name, value = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        """Run report as a dictionary"""
+
+        with self.lock:
+            return {'account':  self.account,
+                    'started':  self.started,
+                    'seconds':  time.time() - self.started,
+                    'buckets':  self.buckets,
+                    'stages':   json.loads(json.dumps(self.stages)),
+                    'counters': dict(self.counters)}
+
+    def summary(self):
+        """Run report as plain text"""
+
+        report = self.report()
+        lines  = ["Run time: %.1fs" % report['seconds']]
+        for name, stage in sorted(report['stages'].items()):
+            mean   = stage['seconds'] / max(stage['calls'], 1)
+            lines += ["%-10s %7d calls %9.2fs (mean %.3fs, max %.3fs)" %
+                      (name, stage['calls'], stage['seconds'],
+                       mean, stage['max'])]
+
+        for name, value in sorted(report['counters'].items()):
+            lines += ["%-18s %d" % (name, value)]
+
+        return os.linesep.join(lines)
+
+    def write_json(self, fname):
+        with open(fname + '.tmp', 'w') as fout:
+            json.dump(self.report(), fout, indent = 2, sort_keys = True)
+
+        os.rename(fname + '.tmp', fname)
+
+    def write_prom(self, fname):
+        """Write the report in the Prometheus textfile collector format"""
+
+        report  = self.report()
+        account = [] if self.account is None else ['account="%s"' % self.account]
+        labels  = lambda *extra: '{' + ','.join(account + list(extra)) + '}'
+        labels0 = labels() if account else ''
+
+        lines  = ['# TYPE gmail_query_run_seconds gauge',
+                  'gmail_query_run_seconds%s %f' % (labels0, report['seconds']),
+                  '# TYPE gmail_query_stage_seconds histogram']
+
+        for name, stage in sorted(report['stages'].items()):
+            lbl = 'stage="%s"' % name
+            for le, n in zip(self.buckets, stage['buckets']):
+                lines += ['gmail_query_stage_seconds_bucket%s %d' %
+                          (labels(lbl, 'le="%s"' % le), n)]
+
+            lines += ['gmail_query_stage_seconds_bucket%s %d' %
+                      (labels(lbl, 'le="+Inf"'), stage['calls']),
+                      'gmail_query_stage_seconds_sum%s %f' %
+                      (labels(lbl), stage['seconds']),
+                      'gmail_query_stage_seconds_count%s %d' %
+                      (labels(lbl), stage['calls'])]
+
+        for name, value in sorted(report['counters'].items()):
+            lines += ['# TYPE gmail_query_%s_total counter' % name,
+                      'gmail_query_%s_total%s %d' % (name, labels0, value)]
+
+        with open(fname + '.tmp', 'w') as fout:
+            fout.write(os.linesep.join(lines) + os.linesep)
+
+        os.rename(fname + '.tmp', fname)
+
+class fair_pool():
+
+    """Worker threads shared by several accounts, scheduled round-robin
+
+    Drop-in for ThreadPool.map. Tasks are queued by account (see
+    account) and idle workers take them from the accounts in turn, so
+    one account's backlog never starves the others. Concurrent map()
+    calls of the same account take turns within its share.
+    """
+
+    def __init__(self, workers = 8):
+        self.queues = {}
+        self.keys   = []
+        self.turn   = 0
+        self.cond   = threading.Condition()
+        for i in range(workers):
+            worker = threading.Thread(target = self.work)
+            worker.daemon = True
+            worker.start()
+
+    def account(self, key):
+        """ThreadPool-like view of this pool whose tasks are key's"""
+
+        return fair_share(self, key)
+
+    def map(self, fun, items, key = None):
+        """Apply fun to every item in items; return results in order
+
+        Kwargs:
+            key: Account the tasks are queued under (each call is its
+                own account if None)
+        """
+
+        items = list(items)
+        if not items:
+            return []
+
+        key   = object() if key is None else key
+        batch = {'fun':     fun,
+                 'tasks':   deque(enumerate(items)),
+                 'results': [None] * len(items),
+                 'pending': len(items),
+                 'error':   None,
+                 'done':    threading.Event()}
+
+        with self.cond:
+            if key not in self.queues:
+                self.queues[key] = deque()
+                self.keys.append(key)
+
+            self.queues[key].append(batch)
+            self.cond.notify_all()
+
+        batch['done'].wait()
+        if batch['error'] is not None:
+            raise batch['error']
+
+        return batch['results']
+
+    def work(self):
+        while True:
+            with self.cond:
+                while not self.keys:
+                    self.cond.wait()
+
+                self.turn = self.turn % len(self.keys)
+                key       = self.keys[self.turn]
+                batches   = self.queues[key]
+                batch     = batches[0]
+                i, item   = batch['tasks'].popleft()
+                if batch['tasks']:
+                    batches.rotate(-1)
+                else:
+                    batches.popleft()
+
+                if batches:
+                    self.turn += 1
+                else:
+                    del self.queues[key]
+                    self.keys.remove(key)
+
+            # Anything a task raises (KeyboardInterrupt too) goes back to
+            # the caller, which would otherwise wait forever
+            try:
+                res = batch['fun'](item)
+            except BaseException as e:
+                res = None
+                batch['error'] = e
+
+            with self.cond:
+                batch['results'][i] = res
+                batch['pending'] -= 1
+                if batch['pending'] == 0:
+                    batch['done'].set()
+
+class fair_share():
+
+    """One account's share of a fair_pool, with ThreadPool's map"""
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key  = key
+
+    def map(self, fun, items):
+        return self.pool.map(fun, items, self.key)
+
+class request_budget():
+
+    """Shared budget of concurrent requests and quota units per second"""
+
+    def __init__(self, workers = 8, rate = 250):
+        """Shared request budget
+
+        Kwargs:
+            workers: Maximum requests in flight.
+            rate: Quota units per second (Gmail allows 250 per user).
+        """
+
+        self.workers = threading.BoundedSemaphore(workers)
+        self.rate    = rate
+        self.tokens  = rate
+        self.stamp   = time.time()
+        self.lock    = threading.Lock()
+        self.calls   = 0
+        self.units   = 0
+
+    def acquire(self, units):
+        """Block until units are available, then spend them"""
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp  = now
+                if self.tokens >= units:
+                    self.tokens -= units
+                    self.calls  += 1
+                    self.units  += units
+                    return
+
+                wait = (units - self.tokens) / self.rate
+
+            time.sleep(wait)
+
+class att_budget():
+
+    """Attachment bytes a run may download, in total and per thread
+
+    Attachments are planned from the sizes in the part index, before
+    anything is downloaded, smallest first: small attachments fit in
+    the budget and most threads get all of theirs, while the largest
+    ones are skipped (with the usual [ATTACHMENT T0O LARGE] note) once
+    the budget runs out. Shared by every query_ids call of a run.
+    """
+
+    def __init__(self, run = '', thread = ''):
+        """Attachment bytes a run may download, in total and per thread
+
+        Kwargs:
+            run: Most bytes for the run (e.g. 500MiB; blank is no limit)
+            thread: Most bytes for each thread (blank is no limit)
+        """
+
+        self.run     = parse_string(run) if run else None
+        self.thread  = parse_string(thread) if thread else None
+        self.spent   = 0
+        self.threads = {}
+        self.lock    = threading.Lock()
+
+    def limits(self):
+        """Limits as bytes (None if unlimited), for render_options"""
+
+        return [None if limit is None else int(limit.bytes)
+                for limit in [self.run, self.thread]]
+
+    def plan(self, msgs, indexes, msize):
+        """Decide which attachments of msgs to download
+
+        Args:
+            msgs: gmail msgs
+            indexes: index_parts(msg['payload']) of each message
             msize: A bitmath object with max size
 
-        Kwargs:
-            depth: how deep to look for parts in payload
+        Returns:
+            jobs: (size, message, attachment) positions to download,
+                smallest first
+            notes: Dictionary of (message, attachment) -> [file name,
+                note] for attachments over msize or the budget
+        """
+
+        sizes = [(att['size'], i, j)
+                 for i, index in enumerate(indexes)
+                 for j, att in enumerate(index['attachments'])]
+
+        jobs  = []
+        notes = {}
+        with self.lock:
+            for size, i, j in sorted(sizes):
+                att = indexes[i]['attachments'][j]
+                thr = msgs[i]['threadId']
+                if size >= msize.bytes:
+                    notes[(i, j)] = att_too_large(att['filename'], size, msize)
+                    continue
+                elif att['data'] is not None:
+                    continue  # Sent inline with the message
+
+                run_left = None
+                thr_left = None
+                if self.run is not None:
+                    run_left = self.run.bytes - self.spent
+
+                if self.thread is not None:
+                    thr_left = self.thread.bytes - self.threads.get(thr, 0)
+
+                if run_left is not None and size > run_left:
+                    notes[(i, j)] = att_too_large(
+                        att['filename'], size, bytes_bm(run_left),
+                        "the run's attachment budget had")
+                elif thr_left is not None and size > thr_left:
+                    notes[(i, j)] = att_too_large(
+                        att['filename'], size, bytes_bm(thr_left),
+                        "the thread's attachment budget had")
+                else:
+                    self.spent       += size
+                    self.threads[thr] = self.threads.get(thr, 0) + size
+                    jobs += [(size, i, j)]
+
+        return jobs, notes
+
+def collect_atts(indexes, notes, fetched):
+    """parse_att output for each message from an att_budget plan
+
+    Args:
+        indexes: index_parts(msg['payload']) of each message
+        notes: Notes from att_budget.plan
+        fetched: Dictionary of (message, attachment) -> downloaded data
+
+    Returns:
+        [attachment file names, attachment data, attachment sizes] for
+        each message
+    """
+
+    atts = []
+    for i, index in enumerate(indexes):
+        att_fns  = []
+        att_data = []
+        for j, att in enumerate(index['attachments']):
+            if (i, j) in notes:
+                fn, data = notes[(i, j)]
+            else:
+                fn   = att['filename']
+                data = to_bytes(fetched.get((i, j), att['data']))
+
+            att_fns  += [fn]
+            att_data += [data]
+
+        atts += [[att_fns, att_data,
+                  [att['size'] for att in index['attachments']]]]
+
+    return atts
+
+def bytes_bm(nbytes):
+    """nbytes as a bitmath object with the best prefix"""
+
+    return parse_string('{:.9f}B'.format(max(nbytes, 0))).best_prefix()
+
+def get_credentials(app_name,
+                    client_secret_file,
+                    scopes,
+                    flags = None,
+                    credential_path = None):
+    """Gets valid user credentials from storage.
+
+    If nothing has been stored, or if the stored credentials are invalid,
+    the OAuth2 flow is completed to obtain the new credentials.
+
+    Kwargs:
+        credential_path: Credential store (default is
+            ~/.credentials/gmail-python-quickstart.json)
+
+    Returns:
+        Credentials, the obtained credential.
+    """
+
+    if credential_path is None:
+        home_dir = os.path.expanduser('~')
+        credential_path = os.path.join(home_dir,
+                                       '.credentials',
+                                       'gmail-python-quickstart.json')
+
+    credential_dir = os.path.dirname(credential_path)
+    if not os.path.exists(credential_dir):
+        os.makedirs(credential_dir)
+
+    store = oauth2client.file.Storage(credential_path)
+    credentials = store.get()
+    if not credentials or credentials.invalid:
+        flow = client.flow_from_clientsecrets(client_secret_file, scopes)
+        flow.user_agent = app_name
+        if flags:
+            credentials = tools.run_flow(flow, store, flags)
+        else:  # Needed only for compatibility with Python 2.6
+            credentials = tools.run(flow, store)
+
+        print('Storing credentials to ' + credential_path)
+
+    return credentials
+
+def index_parts(payload, prefer = 'text/html'):
+    """Index every part of a message payload in one pass
+
+    Args:
+        payload: msg['payload'] from the Gmail API
+
+    Kwargs:
+        prefer: Preferred body type (text/html or text/plain)
+
+    Returns:
+        Dictionary with
+            body: The first part of type prefer, else the first
+                text/html or text/plain part (None if there is none)
+            alternates: Every other text/html or text/plain part
+            attachments: Every part with a filename, in order, as
+                dictionaries with filename, mimeType, partId,
+                attachmentId, size, data (set if Gmail sent the data
+                inline) and cid (Content-ID, blank if none)
+            inline: Dictionary of Content-ID -> attachment
+
+        Parts are visited once each, in document order, with an explicit
+        stack, so cost is linear in the number of parts at any depth.
+    """
+
+    texts  = []
+    index  = {'body': None, 'alternates': [], 'attachments': [], 'inline': {}}
+    stack  = [payload]
+    while stack:
+        part = stack.pop()
+        stack.extend(reversed(part.get('parts') or []))
+
+        body = part.get('body') or {}
+        if part.get('filename'):
+            heads = dict((h['name'].lower(), h['value'])
+                         for h in part.get('headers') or [])
+            att   = {'filename':     part['filename'],
+                     'mimeType':     part.get('mimeType'),
+                     'partId':       part.get('partId'),
+                     'attachmentId': body.get('attachmentId'),
+                     'size':         body.get('size', 0),
+                     'data':         body.get('data'),
+                     'cid':          heads.get('content-id', '').strip('<> ')}
+            index['attachments'] += [att]
+            if att['cid']:
+                index['inline'][att['cid']] = att
+        elif part.get('mimeType') in ['text/html', 'text/plain'] and 'data' in body:
+            texts += [part]
+
+    for part in texts:
+        if part['mimeType'] == prefer:
+            index['body'] = part
+            break
+    else:
+        index['body'] = texts[0] if texts else None
+
+    index['alternates'] = [part for part in texts if part is not index['body']]
+    return index
+
+def part_depth(payload):
+    """Levels of parts nested below payload (0 for a single part)"""
+
+    depth = 0
+    stack = [(payload, 0)]
+    while stack:
+        part, level = stack.pop()
+        depth       = max(depth, level)
+        stack.extend((sub, level + 1) for sub in part.get('parts') or [])
+
+    return depth
+
+def body_size(payload):
+    """Bytes in the parts of payload that are not attachments"""
+
+    size  = 0
+    stack = [payload]
+    while stack:
+        part   = stack.pop()
+        stack.extend(part.get('parts') or [])
+        if not part.get('filename'):
+            size += (part.get('body') or {}).get('size', 0)
+
+    return size
+
+def render_head(head, otype):
+    """Render header lines ('**Name:** value') as otype without pandoc"""
+
+    lines = list(filter(None, head))
+    if otype == 'plain':
+        return os.linesep.join(lines).replace('*', '')
+    elif otype not in ['html', 'html5']:
+        return ('  ' + os.linesep).join(lines)
+
+    html = []
+    for line in lines:
+        name, value = re.match(r'^\*\*(.*?)\*\* ?(.*)$', line).groups()
+        html += ['<strong>%s</strong> %s' % (escape_html(name),
+                                             escape_html(value))]
+
+    return '<p>' + ('<br />' + os.linesep).join(html) + '</p>'
+
+def render_body(body, otype, mime = 'text/html'):
+    """Render a message body as otype without pandoc
+
+    Args:
+        body: Decoded body (bytes or text)
+        otype: One of native_formats
+
+    Kwargs:
+        mime: text/html (rendered with html_renderer) or text/plain
+
+    Returns:
+        Rendered body
+    """
+
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+
+    target = 'plain' if otype == 'plain' else \
+        'html' if otype in ['html', 'html5'] else 'markdown'
+
+    if mime == 'text/plain':
+        return '<pre>%s</pre>' % escape_html(body) if target == 'html' else body
+
+    renderer = html_renderer(target)
+    renderer.feed(body)
+    renderer.close()
+    return renderer.render()
+
+# data: URIs in attributes and CSS url(), and style attributes (<style>
+# blocks are cut by strip_styles). The media type is bounded so a body
+# of unterminated data: URIs is still scanned in linear time.
+data_uri_re   = re.compile(br'''((?:=|url\()\s*["']?)'''
+                           br'''data:[^,"'()<>\s]{0,256},[^"'()<>]*''',
+                           re.IGNORECASE)
+style_attr_re = re.compile(br'''\sstyle\s*=\s*(?:"[^"]*"|'[^']*')''',
+                           re.IGNORECASE)
+# Stored in the manifest options; bump when strip_html changes its output
+strip_version = 1
+
+def strip_html(body):
+    """Remove inline data and CSS from an HTML body before conversion
+
+    data: URIs (mostly base64 images) in attributes and CSS become the
+    empty `data:,`; <style> blocks and style attributes are removed.
+    None of them make it into the converted body, and in large bodies
+    they are most of the bytes.
+
+    Returns:
+        body: Stripped body (bytes)
+        stripped: Bytes removed
+    """
+
+    body = to_bytes(body)
+    size = len(body)
+    body = data_uri_re.sub(br'\1data:,', body)
+    body = strip_styles(body)
+    body = style_attr_re.sub(b'', body)
+    return body, size - len(body)
+
+def strip_styles(body):
+    """body (bytes) without its <style> blocks, in one pass
+
+    A block that is never closed runs to the end of the body.
+    """
+
+    lower = body.lower()
+    parts = []
+    pos   = 0
+    while True:
+        start = lower.find(b'<style', pos)
+        if start < 0:
+            break
+
+        # <stylesheet> and the like are other tags
+        after = lower[start + 6:start + 7]
+        if after.isalnum() or after in (b'_', b'-'):
+            parts += [body[pos:start + 6]]
+            pos    = start + 6
+            continue
+
+        parts += [body[pos:start]]
+        pos    = len(body)
+        end    = lower.find(b'</style', start + 6)
+        while end >= 0:
+            close = end + 7
+            while lower[close:close + 1].isspace():
+                close += 1
+
+            if lower[close:close + 1] == b'>':
+                pos = close + 1
+                break
+
+            end = lower.find(b'</style', close)
+
+        if pos == len(body):
+            break
+
+    return b''.join(parts + [body[pos:]])
+
+def unsafe_url(url):
+    """Whether url runs script or carries its own content (data:)
+
+    Browsers ignore whitespace and control characters in the scheme.
+    """
+
+    url = re.sub(r'[\x00-\x20]+', '', url)
+    return re.match(r'(javascript|vbscript|data):', url, re.I) is not None
+
+def escape_html(text, quote = False):
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.replace('"', '&quot;') if quote else text
+
+class html_renderer(HTMLParser):
+
+    """Render HTML as plain text, markdown or sanitized HTML
+
+    A streaming parser: output is built as tags and text arrive, with
+    the open lists, links and quotes on small stacks and no document
+    tree. Scripts, styles and other active content are dropped. For
+    'html', only safe tags and attributes are kept (no event handlers,
+    no javascript: links).
+
+    Usage
+    -----
+
+    >>> renderer = html_renderer('markdown')
+    >>> renderer.feed('<p>Hello <b>world</b></p>')
+    >>> renderer.close()
+    >>> renderer.render()
+    'Hello **world**'
+    """
+
+    skip_tags  = set(['script', 'style', 'head', 'title', 'object', 'embed',
+                      'iframe', 'noscript', 'template', 'applet', 'svg'])
+    void_tags  = set(['area', 'base', 'br', 'col', 'hr', 'img', 'input',
+                      'link', 'meta', 'wbr'])
+    block_tags = set(['address', 'article', 'aside', 'center', 'dd', 'div',
+                      'dl', 'dt', 'footer', 'header', 'p', 'section',
+                      'table'])
+    safe_tags  = set(['a', 'abbr', 'b', 'blockquote', 'br', 'caption',
+                      'center', 'code', 'col', 'colgroup', 'dd', 'del',
+                      'div', 'dl', 'dt', 'em', 'font', 'h1', 'h2', 'h3',
+                      'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'li', 'ol',
+                      'p', 'pre', 'q', 's', 'small', 'span', 'strike',
+                      'strong', 'sub', 'sup', 'table', 'tbody', 'td',
+                      'tfoot', 'th', 'thead', 'tr', 'u', 'ul'])
+    safe_attrs = set(['align', 'alt', 'border', 'cellpadding', 'cellspacing',
+                      'color', 'colspan', 'face', 'height', 'href', 'rowspan',
+                      'size', 'src', 'title', 'valign', 'width'])
+
+    def __init__(self, target = 'markdown'):
+        """Render HTML as plain text, markdown or sanitized HTML
+
+        Kwargs:
+            target: 'plain', 'markdown' or 'html'
+        """
+
+        try:
+            HTMLParser.__init__(self, convert_charrefs = True)
+        except TypeError:
+            HTMLParser.__init__(self)  # Python 2 (see handle_entityref)
+
+        self.target = target
+        self.md     = target == 'markdown'
+        self.out    = []
+        self.skip   = 0
+        self.pre    = 0
+        self.quote  = 0
+        self.quoted = 0
+        self.lists  = []
+        self.links  = []
+        self.cells  = 0
+        self.breaks = 0
+        self.start  = True
+
+    def render(self):
+        return ''.join(self.out).strip()
+
+    # Output
+    # ------
+
+    def newline(self, n = 1):
+        """Break the line (n = 2 for a blank line) before the next text"""
+
+        if self.out:
+            self.breaks = max(self.breaks, n)
+
+    def emit(self, text):
+        """Append text as is, after any pending line breaks"""
+
+        if self.breaks:
+            # Blank lines only stay quoted between lines of one quote
+            blank = ('> ' * min(self.quote, self.quoted)).rstrip()
+            if self.out[-1] != '  ':
+                self.out[-1] = self.out[-1].rstrip(' ')
+
+            self.out  += [('\n' + blank) * (self.breaks - 1) +
+                          '\n' + '> ' * self.quote]
+            self.breaks = 0
+            self.start  = True
+        elif self.start and self.quote and not self.out:
+            # A body that opens with a quote (breaks before it are dropped)
+            self.out += ['> ' * self.quote]
+
+        self.quoted = self.quote
+
+        if text:
+            self.out  += [text]
+            self.start = text.endswith('\n')
+
+    # Parser callbacks
+    # ----------------
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.skip_tags:
+            self.skip += 0 if tag in self.void_tags else 1
+        elif self.skip:
+            pass
+        elif self.target == 'html':
+            self.html_start(tag, attrs)
+        else:
+            self.text_start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        if tag in self.skip_tags:
+            self.skip = max(self.skip - 1, 0)
+        elif self.skip:
+            pass
+        elif self.target == 'html':
+            if tag in self.safe_tags and tag not in self.void_tags:
+                self.out += ['</%s>' % tag]
+        else:
+            self.text_end(tag)
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        elif self.target == 'html':
+            self.out += [escape_html(data)]
+        elif self.pre:
+            self.emit(data.replace('\n', '\n' + '> ' * self.quote))
+        else:
+            data = re.sub(r'\s+', ' ', data)
+            if self.start or self.breaks:
+                data = data.lstrip()
+
+            if self.md:
+                data = re.sub(r'([\\`*_\[\]])', r'\\\1', data)
+
+            if data:
+                self.emit(data)
+
+    def handle_entityref(self, name):
+        if name in name2codepoint:
+            self.handle_data(unichr(name2codepoint[name]))
+        else:
+            self.handle_data('&' + name)
+
+    def handle_charref(self, name):
+        try:
+            if name[0] in 'xX':
+                self.handle_data(unichr(int(name[1:], 16)))
+            else:
+                self.handle_data(unichr(int(name)))
+        except ValueError:
+            pass
+
+    # Sanitized HTML
+    # --------------
+
+    def html_start(self, tag, attrs):
+        if tag not in self.safe_tags:
+            return
+
+        keep = []
+        for name, value in attrs:
+            value = value or ''
+            if name in self.safe_attrs and not unsafe_url(value):
+                keep += [' %s="%s"' % (name, escape_html(value, True))]
+
+        self.out += ['<%s%s%s>' % (tag, ''.join(keep),
+                                   ' /' if tag in self.void_tags else '')]
+
+    # Plain text and markdown
+    # -----------------------
+
+    def text_start(self, tag, attrs):
+        md = self.md
+        if tag == 'br':
+            self.emit('  ' if md else '')
+            self.newline(1)
+        elif tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6']:
+            self.newline(2)
+            self.emit('#' * int(tag[1]) + ' ' if md else '')
+        elif tag in ['ul', 'ol']:
+            self.newline(1 if self.lists else 2)
+            self.lists += [[tag, 0]]
+        elif tag == 'li':
+            self.newline(1)
+            kind, n = self.lists[-1] if self.lists else ['ul', 0]
+            if self.lists:
+                self.lists[-1][1] += 1
+
+            indent = '    ' * max(len(self.lists) - 1, 0)
+            self.emit(indent + ('%d. ' % (n + 1) if kind == 'ol' else '- '))
+        elif tag == 'blockquote':
+            self.newline(2)
+            self.quote += 1
+        elif tag == 'pre':
+            self.newline(2)
+            if md:
+                self.emit('```')
+                self.newline(1)
+
+            self.pre += 1
+        elif tag == 'code' and not self.pre:
+            self.emit('`' if md else '')
+        elif tag in ['strong', 'b']:
+            self.emit('**' if md else '')
+        elif tag in ['em', 'i']:
+            self.emit('*' if md else '')
+        elif tag == 'a':
+            href = attrs.get('href') or ''
+            self.links += [('' if unsafe_url(href) else href, len(self.out))]
+            self.emit('[' if md else '')
+        elif tag == 'img':
+            alt = attrs.get('alt') or ''
+            if md:
+                self.emit('![%s](%s)' % (alt, attrs.get('src') or ''))
+            elif alt:
+                self.emit('[%s]' % alt)
+        elif tag == 'hr':
+            self.newline(2)
+            self.emit('---' if md else '-' * 72)
+            self.newline(2)
+        elif tag == 'tr':
+            self.newline(1)
+            self.cells = 0
+        elif tag in ['td', 'th']:
+            if self.cells:
+                self.emit(' | ')
+
+            self.cells += 1
+        elif tag in self.block_tags:
+            self.newline(1 if tag == 'div' else 2)
+
+    def text_end(self, tag):
+        md = self.md
+        if tag in ['h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'p', 'table']:
+            self.newline(2)
+        elif tag in ['ul', 'ol']:
+            self.lists = self.lists[:-1]
+            self.newline(1 if self.lists else 2)
+        elif tag == 'blockquote':
+            self.quote = max(self.quote - 1, 0)
+            self.newline(2)
+        elif tag == 'pre':
+            self.pre = max(self.pre - 1, 0)
+            if md:
+                self.newline(1)
+                self.emit('```')
+
+            self.newline(2)
+        elif tag == 'code' and not self.pre:
+            self.emit('`' if md else '')
+        elif tag in ['strong', 'b']:
+            self.emit('**' if md else '')
+        elif tag in ['em', 'i']:
+            self.emit('*' if md else '')
+        elif tag == 'a' and self.links:
+            href, at = self.links.pop()
+            text = ''.join(self.out[at:]).strip('[ ')
+            if md:
+                self.emit('](%s)' % href if href else ']')
+            elif href and text != href and href != 'mailto:' + text:
+                self.emit(' <%s>' % href)
+        elif tag in self.block_tags:
+            self.newline(1 if tag == 'div' else 2)
+
+def att_too_large(att_fn, att_size, msize, limit = 'limit set to'):
+    """File name and note saved in place of an attachment over msize"""
+
+    att_bm    = bytes_bm(att_size)
+    msg_size  = 'NOTE: Att size was %s but ' + limit + ' %s'
+    msize_str = msize.format("{value:.1f} {unit}")
+    att_str   = att_bm.format("{value:.1f} {unit}")
+    return [att_fn + ' [ATTACHMENT T0O LARGE]', msg_size % (att_str, msize_str)]
+
+def messages_df(msg_ids, thr_ids, parsed, atts, first):
+    """Data frame with parsed messages, sorted by thread and date
+
+    Args:
+        msg_ids: Message ids
+        thr_ids: Thread id of each message
+        parsed: parse_msg output for each message
+        atts: parse_att output for each message
+        first: Whether to sort each thread by first message
+
+    Returns:
+        df: Data frame with one message per row. Messages are ordered
+            by their epoch milliseconds (stamp), and by id within the
+            same millisecond, so the order is the same on every run.
+    """
+
+    cols  = ['threadId',
+             'body',
+             'ft_header',
+             'header',
+             'date',
+             'subject',
+             'from',
+             'to',
+             'cc',
+             'ctype',
+             'stamp',
+             'fn',
+             'att',
+             'att_size']
+    dtzip = zip(thr_ids, parsed, atts)
+    dt    = [[thr] + pmsg + att for thr, pmsg, att in dtzip]
+    df    = pd.DataFrame(dt, index = msg_ids, columns = cols)
+
+    # mergesort is stable, so ties keep the id order
+    return df.sort_index().sort_values(by = ['threadId', 'stamp'],
+                                       ascending = [True, not first],
+                                       kind = 'mergesort')
+
+def suffix_fname(fname, suffix):
+    """Add -suffix to fname before its extension (blank stays blank)"""
+
+    if not fname:
+        return fname
+
+    base, ext = os.path.splitext(fname)
+    return base + '-' + suffix + ext
+
+def pandoc_formats(metrics = None, formats = []):
+    """pandoc.get_pandoc_formats(), run once per process"""
+
+    if metrics is not None:
+        metrics.count('cache_hits' if formats else 'cache_misses')
+
+    if not formats:
+        formats += list(pandoc.get_pandoc_formats())
+
+    return formats
+
+def output_types(renderer, otype, metrics = None):
+    """Output types renderer can produce
+
+    pandoc is only asked for its formats when it will be used, so native
+    (and auto, for native formats) runs never start it.
+    """
+
+    if renderer == 'native':
+        return native_formats
+    elif renderer == 'auto' and otype in native_formats + ['eml']:
+        return native_formats
+    else:
+        return pandoc_formats(metrics)[1]
+
+def native_render(renderer, otype):
+    """Whether renderer writes otype without pandoc"""
+
+    ctype = 'html' if otype == 'eml' else otype
+    return renderer == 'native' or \
+        (renderer == 'auto' and ctype in native_formats)
+
+def date_range(start, end):
+    """All days from start to end (inclusive) as YYYY-MM-DD strings"""
+
+    startdt = datetime.datetime.strptime(start, "%Y-%m-%d")
+    enddt   = datetime.datetime.strptime(end, "%Y-%m-%d")
+    ndays   = (enddt - startdt).days
+    if ndays < 0:
+        raise Warning("'{}' is after '{}'".format(start, end))
+
+    return [(startdt + datetime.timedelta(days = d)).strftime("%Y-%m-%d")
+            for d in range(ndays + 1)]
+
+def todays_query(todays, bdays):
+    """Gmail search query for todays and bdays before it"""
+
+    # Gmail queries date >= after and date < before
+    todaydt  = datetime.datetime.strptime(todays, "%Y-%m-%d")
+    tomorrow = todaydt + datetime.timedelta(days = 1)
+    todaydt  = todaydt + datetime.timedelta(days = -bdays)
+    return "after:%s before:%s" % (todaydt.strftime("%Y-%m-%d"),
+                                   tomorrow.strftime("%Y-%m-%d"))
+
+def day_window(day, timezone):
+    """Epoch seconds of local midnight at day and the day after"""
+
+    daydt  = datetime.datetime.strptime(day, "%Y-%m-%d")
+    after  = daydt.replace(tzinfo = timezone)
+    before = (daydt + datetime.timedelta(days = 1)).replace(tzinfo = timezone)
+    return (calendar.timegm(after.utctimetuple()),
+            calendar.timegm(before.utctimetuple()))
+
+def msg_headers(payload, names = head_names):
+    """Headers in names (lowercase) from payload, in one pass
+
+    Header names are case-insensitive, so they are matched lowercased;
+    the first of a repeated header wins.
+    """
+
+    head = {}
+    for header in payload.get('headers', []):
+        name = header['name'].lower()
+        if name in names and name not in head:
+            head[name] = header['value']
+
+    return head
+
+def local_dates(stamps, timezone):
+    """Local datetimes of epoch millisecond stamps (e.g. internalDate)
+
+    The offset (and DST fold) of timezone is looked up once for each
+    quarter hour the stamps fall in, rather than once per stamp, since
+    offsets only change on quarter hours. None stays None.
+    """
+
+    refs  = {}
+    dates = []
+    for stamp in stamps:
+        if stamp is None:
+            dates += [None]
+            continue
+
+        quarter, ms = divmod(int(stamp), 900000)
+        ref = refs.get(quarter)
+        if ref is None:
+            ref = refs[quarter] = datetime.datetime.fromtimestamp(quarter * 900,
+                                                                  timezone)
+
+        date   = ref + datetime.timedelta(milliseconds = ms)
+        dates += [tz.enfold(date) if getattr(ref, 'fold', 0) else date]
+
+    return dates
+
+def print_df_query(df, outdir, tzstr, otype, ext,
+                   metrics  = None,
+                   writer   = None,
+                   manifest = None,
+                   options  = None,
+                   layout   = 'flat'):
+    """Print all messages from df into outdir
+
+    Args:
+        df: df with e-mail
+        outdir: output directory
+
+    Kwargs:
+        metrics: run_metrics object to count bytes written
+        writer: output_writer to write the files with (default writes
+            them one at a time in this thread)
+        manifest: output_manifest of the output root. Threads it has
+            a folder for are written into that folder (wherever sorting
+            moved it), and messages whose output is unchanged are not
+            written again.
+        options: Render options (see render_options) for manifest
+        layout: Where new thread folders go within outdir (see
+            layout_shard)
+
+    Returns:
+        Prints to outdir; returns the new thread folders
+
+    """
+
+    mkdir_recursive(outdir)
+    outpaths = []
+    outfiles = []
+    for thr, dfmsg in df.groupby('threadId', sort = False):
+        outpath = None if manifest is None else manifest.folder(thr)
+        if outpath is None:
+            outdt     = dfmsg['date'].iloc[-1].strftime("%Y-%m-%d %H:%M " + tzstr)
+            outsub    = dfmsg['subject'].iloc[-1][:32].replace('/', '|')
+            outshard  = layout_shard(layout, thr, dfmsg['date'].iloc[-1],
+                                     dfmsg['header'].iloc[-1])
+            outfolder = os.path.join(outdir, outshard, outdt + ' - ' + outsub)
+            outpath   = ''.join(filter(lambda x: x in string.printable, outfolder))
+            outpaths += [outpath]
+
+        for i in range(len(dfmsg)):
+            files = render_df_msg(dfmsg.iloc[i], outpath, tzstr, otype, ext)
+            if manifest is not None:
+                digest = message_digest(dfmsg.iloc[i])
+                if not manifest.record(dfmsg.index[i], thr, outpath,
+                                       [fname for fname, content in files],
+                                       digest, options):
+                    if metrics is not None:
+                        metrics.count('messages_unchanged')
+
+                    continue
+
+            outfiles += files
+
+    writer = output_writer(0) if writer is None else writer
+    writer.write_all(outfiles, metrics)
+    return outpaths
+
+def layout_shard(layout, thr_id, date, header):
+    """Shard folder, within the day folder, of a new thread folder
+
+    Args:
+        layout: 'flat' (no shard folder), 'hour' (the hour of date,
+            00-23), 'domain' (the e-mail domain of the From line in
+            header) or 'hash' (the first two hex digits of the md5 of
+            thr_id, so at most 256 shards)
+        thr_id: Thread id
+        date: Date of the message the thread folder is named after
+        header: Its plain text header
+
+    Returns:
+        Shard folder name ('' for the flat layout)
+    """
+
+    if layout == 'hour':
+        return date.strftime('%H')
+    elif layout == 'domain':
+        domain = re.search(r'^From:.*@([\w.-]+)', header, re.MULTILINE)
+        domain = domain.group(1).lower().strip('.') if domain else ''
+        return domain if domain else 'unknown'
+    elif layout == 'hash':
+        return hashlib.md5(to_bytes(thr_id)).hexdigest()[:2]
+    else:
+        return ''
+
+def print_df_msg(dfmsg, dest, tzstr, otype, ext, metrics = None):
+    """Print message out to file
+
+    Args:
+        dfmsg: Row of df with the message
+        dest: Output folder
+
+    Returns:
+        Prints message (and attachments) to files in dest
+    """
+
+    output_writer(0).write_all(render_df_msg(dfmsg, dest, tzstr, otype, ext),
+                               metrics)
+
+def render_df_msg(dfmsg, dest, tzstr, otype, ext):
+    """Render message into the contents of its output files
+
+    Args:
+        dfmsg: Row of df with the message
+        dest: Output folder
+
+    Returns:
+        List of (file name, content) pairs, where content is bytes, a
+        function returning bytes (attachments are decoded when they
+        are written, in the writer's threads) or a generator of byte
+        chunks (eml files with attachments; see eml_stream).
+    """
+
+    dstr = "%Y-%m-%d %H:%M " + tzstr
+    h    = dfmsg['header']
+    fh   = dfmsg['ft_header']
+    b    = dfmsg['body']
+    f    = dfmsg['date'].strftime(dstr)
+    fn   = dfmsg['fn']
+    a    = dfmsg['att']
+
+    lines = []
+    def add(text):
+        lines.append(to_bytes(text) + b'\n')
+
+    files = []
+    if otype != 'eml':
+        add(fh + os.linesep + os.linesep)
+        add(b)
+        files += [(os.path.join(dest, f + ext), b''.join(lines))]
 
-        Returns:
-            All attachments found in msg, or None
+        for att_fn, att in zip(fn, a):
+            if att_fn.endswith(' [ATTACHMENT T0O LARGE]'):
+                content = to_bytes(att)
+            else:
+                content = functools.partial(base64.urlsafe_b64decode,
+                                            to_bytes(att))
 
-        """
+            files += [(os.path.join(dest, att_fn), content)]
 
-        if msize is None:
-            return [None, None]
+    if otype == 'eml' and fn:
+        msg_sep = '-q1w2e3r4t5'
+        msg_c   = 'Content-type: multipart/mixed; boundary="%s"' % msg_sep
+        hlist   = h.split(os.linesep)
+        header  = os.linesep.join(hlist[:-1] + ['MIME-Version: 1.0', msg_c])
+        msg_h   = hlist[-1] + os.linesep + 'Content-Disposition: inline'
 
-        parts    = msg['payload']
-        att_fn   = None
-        att_data = None
-        found    = False
-        try:
-            i = 0
-            while not found and i < depth:
-                i += 1
-                parts, found = get_next_part(parts,
-                                             search   = 'filename',
-                                             negation = True,
-                                             allowed  = u'')
-        except:
-            parts = [{'filename': None}]
-
-        for part in parts:
-            if part['filename']:
-                att_fn = part['filename']
-                att_id, att_size = part['body'].values()
-                att_bm = parse_string('{:.9f}B'.format(att_size)).best_prefix()
-                if att_size < msize.bytes:
-                    att  = self.get_att(msg['threadId'], att_id)
-                    body = unicode(att['data']).encode('utf-8')
-                    att_data = body
-                else:
-                    msg_size  = 'NOTE: Att size was %s but limit set to %s'
-                    msize_str = msize.format("{value:.1f} {unit}")
-                    att_str   = att_bm.format("{value:.1f} {unit}")
-                    att_data  = msg_size % (att_str, msize_str)
-                    att_fn   += ' [ATTACHMENT T0O LARGE]'
+        add(header + os.linesep)
+        add('--' + msg_sep)
+        add(msg_h + os.linesep)
+        add(b + os.linesep)
 
-        return [att_fn, att_data]
+        files += [(os.path.join(dest, f + ext),
+                   eml_stream(b''.join(lines), fn, a, msg_sep))]
+    elif otype == 'eml':
+        add(h + os.linesep)
+        add(b)
+        files += [(os.path.join(dest, f + ext), b''.join(lines))]
 
-    def parse_msg(self, msg, otype, prefer = 'text/html', depth = 10):
-        """Get body from message, various formats
+    return files
 
-        Args:
-            message: dictionary with message info from Gmail API
+def eml_stream(head, fns, atts, msg_sep):
+    """Stream a multipart eml file
+
+    Args:
+        head: Header and body part (bytes)
+        fns: Attachment file names
+        atts: Attachment data (Gmail's URL-safe base64)
+        msg_sep: MIME boundary
+
+    Returns:
+        Generator of byte chunks: head, then one MIME part per
+        attachment (base64 translated and wrapped a chunk at a time, see
+        wrap_base64), then the closing boundary.
+    """
+
+    yield head
+    for att_fn, att in zip(fns, atts):
+        too_large = att_fn.endswith(' [ATTACHMENT T0O LARGE]')
+        if too_large:
+            att_h = [u'Content-Type: text/plain; name="%s"' % att_fn]
+        else:
+            att_h = [u'Content-Type: application/octet-stream; '
+                     u'name="%s"' % att_fn]
+            att_h += [u'Content-Transfer-Encoding: base64']
+
+        att_h += [u'Content-Disposition: attachment; filename="%s"' % att_fn]
+
+        yield to_bytes('--' + msg_sep + '\n')
+        yield to_bytes(os.linesep.join(att_h) + os.linesep + '\n')
+        if too_large:
+            yield to_bytes(unicode(att) + os.linesep + '\n')
+        else:
+            for chunk in wrap_base64(att):
+                yield chunk
+
+            yield b'\n'
+
+    yield to_bytes('--' + msg_sep + '--\n')
+
+def wrap_base64(data, width = 76, lines = 1024):
+    """Standard base64 lines from Gmail's URL-safe base64 data
+
+    Args:
+        data: URL-safe base64 string
+
+    Kwargs:
+        width: Line width
+        lines: Lines per chunk
+
+    Returns:
+        Generator of byte chunks of up to `lines` lines, each ending in
+        os.linesep. Only one chunk is copied at a time.
+    """
+
+    data  = to_bytes(data)
+    step  = width * lines
+    sep   = to_bytes(os.linesep)
+    for start in range(0, len(data), step):
+        chunk = data[start:start + step].translate(b64_table)
+        yield sep.join([chunk[i:i + width]
+                        for i in range(0, len(chunk), width)]) + sep
+
+class output_writer():
+
+    """Write rendered files from a pool of I/O threads
+
+    Each file is written with one buffered write (contents are rendered
+    in full beforehand, except streamed eml files, which are written a
+    chunk at a time). Folders are created the first time a thread
+    writes into them. With fsync set, written files (and then their
+    folders) are fsynced in batches of that many files.
+    """
+
+    def __init__(self, threads = 8, fsync = 0):
+        """Write rendered files from a pool of I/O threads
 
         Kwargs:
-            prefer: prefer this type
-            depth: how deep to look for parts in payload
+            threads: I/O threads (0 writes in the calling thread)
+            fsync: fsync every this many files (0 never fsyncs)
+        """
+
+        self.threads = threads
+        self.pool    = ThreadPool(threads) if threads > 0 else None
+        self.fsync   = fsync
+        self.local   = threading.local()
+        self.lock    = threading.Lock()
+        self.pending = []
+
+    def write_all(self, files, metrics = None):
+        """Write every (file name, content) pair in files
 
-        Returns: Plain text e-mail exchange
+        Returns:
+            Once every file is written (and fsynced, if set).
         """
 
-        types = ['text/html', 'text/plain']
-        if prefer not in types:
-            raise Warning("Can only search for text/plain or text/html.")
+        write = lambda item: self.write(item[0], item[1], metrics)
+        if self.pool is None:
+            for item in files:
+                write(item)
+        else:
+            chunksize = max(1, len(files) // (4 * self.threads))
+            self.pool.map(write, files, chunksize)
 
-        # Find the message body
-        found = False
-        parts = msg['payload']
+        self.sync()
+
+    def write(self, fname, content, metrics = None):
+        dirs = self.local.__dict__.setdefault('dirs', set())
+        dest = os.path.dirname(fname)
+        if dest not in dirs:
+            mkdir_recursive(dest)
+            dirs.add(dest)
+
+        if callable(content):
+            content = content()
+
+        nbytes = 0
+        with open(fname, 'wb') as fout:
+            for chunk in [content] if isinstance(content, bytes) else content:
+                fout.write(chunk)
+                nbytes += len(chunk)
+
+        if metrics is not None:
+            metrics.count('files_written')
+            metrics.count('bytes_written', nbytes)
+
+        if self.fsync:
+            with self.lock:
+                self.pending.append(fname)
+                batch = self.pending if len(self.pending) >= self.fsync else []
+                if batch:
+                    self.pending = []
+
+            fsync_files(batch)
+
+    def sync(self):
+        """fsync files still waiting for a full batch"""
+
+        with self.lock:
+            batch, self.pending = self.pending, []
+
+        fsync_files(batch)
+
+def fsync_files(fnames):
+    """fsync each file in fnames, then each of their folders"""
 
+    for fname in fnames + sorted(set(map(os.path.dirname, fnames))):
         try:
-            i = 0
-            while not found and i < depth:
-                parts, found = get_next_part(parts, allowed = types)
-                i += 1
+            fd = os.open(fname, os.O_RDONLY)
+        except OSError:
+            continue
 
-            for p in parts:
-                if p['mimeType'] == prefer:
-                    break
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass  # Folders cannot be fsynced on some platforms
+        finally:
+            os.close(fd)
 
-            pmime = p['mimeType']
-            body  = p['body']['data']
-            plain = base64.urlsafe_b64decode(unicode(body).encode('utf-8'))
-        except:
-            pmime = 'text/plain'
-            plain = 'Message body could not be retrieved.'
+@contextmanager
+def file_lock(fname, stale = 300):
+    """Hold lock file fname (created exclusively) for the enclosed block
 
-        if found and pmime != prefer:
-            msg_type = 'Could not find preferred type. Body retrieved as %s.'
-            print(msg_type % pmime)
+    Kwargs:
+        stale: A lock file older than this many seconds was left by a
+            process that died, and is broken
+    """
 
-        # Get headers
-        head = dict((h['name'], h['value']) for h in msg['payload']['headers'])
-        fr   = get_key_set(head, ['From', 'from', 'FROM'], 'Unknown')
-        to   = get_key_set(head, ['To', 'to', 'TO'], 'Unknown')
-        cc   = get_key_set(head, ['Cc', 'cc', 'CC'], None)
-        sub  = get_key_set(head, ['Subject', 'subject', 'SUBJECT'], 'Unknown')
+    while True:
+        try:
+            os.close(os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
 
-        # Get message date
-        datef = str(datetime.datetime.today())
         try:
-            dateu = parse(get_key_set(head, ['Date', 'date', 'DATE'], datef))
-        except:
-            dateu = datetime.datetime.today()
+            if time.time() - os.path.getmtime(fname) > stale:
+                os.remove(fname)
+        except OSError:
+            pass  # Released (or broken) in the meantime
+
+        time.sleep(0.05 + 0.1 * random.random())
 
+    try:
+        yield
+    finally:
         try:
-            datel = dateu.astimezone(self.timezone)
-        except:
-            datel = dateu.replace(tzinfo = self.timezone)
+            os.remove(fname)
+        except OSError:
+            pass
 
-        dates = datel.strftime('%a, %d %b %Y %H:%M:%S ' + self.tzstr)
+class output_manifest():
+
+    """Messages written under an output root
+
+    Kept in <output root>/.gmail_query_manifest.json. Maps each message
+    id to its output files (relative to the root), a hash of its
+    rendered content and the render options used. Reruns use it to skip
+    messages that are already written.
+
+    The thread index, <output root>/.gmail_query_threads.json, maps each
+    thread id to its folder (relative to the root, wherever sorting and
+    the layout put it), so new messages of a thread go to its existing
+    folder instead of another one. It is kept apart from the message
+    manifest so other tools can look threads up without loading it.
+
+    Saves append only their changes, as a line of JSON, to a journal,
+    <output root>/.gmail_query_manifest.log, under a lock file, and read
+    the lines other processes sharing the root (see gmail_query.work)
+    appended since. The journal is folded into the two files above (see
+    compact) at the end of each run (save(compact = True)) and whenever
+    it outgrows them, so a save costs its own changes and the files are
+    rewritten about once per run or doubling of the manifest. During a
+    run, tools that need the latest entries also apply the journal (its
+    first line names the generation it continues).
+    """
 
-        # Format headers
-        ctype = 'html' if otype == 'eml' else otype
-        head  = ['**From:** ' + fr,
-                 '**To:** ' + to,
-                 '**Cc:** ' + cc if cc else cc,
-                 '**Subject:** ' + sub,
-                 '**Date:** ' + dates,
-                 '**Id:** ' + msg['id'],
-                 '**Content-type:** ' + pmime]
+    # Journal bytes past the size of the files before compacting them
+    compact_min = 1 << 20
 
-        md_head    = ('  ' + os.linesep).join(filter(None, head))
-        plain_head = os.linesep.join(filter(None, head)).replace('*', '')
-        ft_head    = pandoc.convert_text(md_head, ctype, format = 'markdown')
-        ft_body    = pandoc.convert_text(plain, ctype,
-                                         format     = 'html',
-                                         extra_args = ['--smart'])
+    def __init__(self, outdir):
+        """Load the manifest of output root outdir (if there is one)"""
 
-        return [ft_body, ft_head, plain_head, datel, sub]
+        self.outdir = outdir
+        self.fname  = os.path.join(outdir, '.gmail_query_manifest.json')
+        self.index  = os.path.join(outdir, '.gmail_query_threads.json')
+        self.journal  = os.path.join(outdir, '.gmail_query_manifest.log')
+        self.lockfile = os.path.join(outdir, '.gmail_query_manifest.lock')
+        self.lock   = threading.RLock()
+        self.changed_messages = set()
+        self.changed_threads  = set()
+        self.messages, self.threads = self.load()
 
-    def get_msg(self, msg_id):
-        return self.messages.get(userId = 'me',
-                                 id     = msg_id,
-                                 format = 'full').execute()
+    def load(self):
+        """Messages and thread index as saved on disk, journal applied"""
 
-    def get_att(self, msg_id, att_id):
-        return self.messages.attachments().get(userId = 'me',
-                                               messageId = msg_id,
-                                               id = att_id).execute()
+        try:
+            manifest = json.load(open(self.fname))
+        except (IOError, ValueError):
+            manifest = {}
 
-def get_credentials(app_name, client_secret_file, scopes, flags = None):
-    """Gets valid user credentials from storage.
+        # Manifests written before the thread index kept threads inline
+        try:
+            threads = json.load(open(self.index))
+        except (IOError, ValueError):
+            threads = manifest.get('threads', {})
 
-    If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is completed to obtain the new credentials.
+        messages        = manifest.get('messages', {})
+        self.generation = manifest.get('generation', 0)
+        self.offset     = 0
+        self.pending    = 0
+        self.replay(messages, threads)
+        return messages, threads
 
-    Returns:
-        Credentials, the obtained credential.
-    """
+    def replay(self, messages, threads):
+        """Apply the journal lines past self.offset to messages and threads
 
-    home_dir = os.path.expanduser('~')
-    credential_dir = os.path.join(home_dir, '.credentials')
-    if not os.path.exists(credential_dir):
-        os.makedirs(credential_dir)
+        Returns:
+            False if the journal was compacted since it was last read
+            (its lines are already in the files; reload them instead)
+        """
 
-    credential_path = os.path.join(credential_dir,
-                                   'gmail-python-quickstart.json')
+        try:
+            fin = open(self.journal, 'rb')
+        except IOError:
+            return True
 
-    store = oauth2client.file.Storage(credential_path)
-    credentials = store.get()
-    if not credentials or credentials.invalid:
-        flow = client.flow_from_clientsecrets(client_secret_file, scopes)
-        flow.user_agent = app_name
-        if flags:
-            credentials = tools.run_flow(flow, store, flags)
-        else:  # Needed only for compatibility with Python 2.6
-            credentials = tools.run(flow, store)
+        with fin:
+            # A journal of an older generation is already in the files
+            try:
+                head = json.loads(fin.readline().decode('utf-8'))
+            except ValueError:
+                return True
 
-        print('Storing credentials to ' + credential_path)
+            if head.get('generation') != self.generation:
+                return head.get('generation', 0) < self.generation
 
-    return credentials
+            fin.seek(max(self.offset, fin.tell()))
+            for line in fin:
+                # The last line of a save that was cut short
+                if not line.endswith(b'\n'):
+                    break
 
-def get_next_part(msg, what = 'parts', search = 'mimeType',
-                  negation = False, allowed = ['text/html', 'text/plain']):
-    """Find the next level down of msg
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                    messages.update(entry.get('messages', {}))
+                    threads.update(entry.get('threads', {}))
+                except ValueError:
+                    pass
 
-    Args:
-        msg: Dictionary object
+                self.offset   = fin.tell()
+                self.pending += 1
 
-    Kwargs:
-        what: Key to find.
-        search: Key criteria.
-        allowed: If key not in allowed, search deeper.
+        return True
 
-    Returns:
-        Next level (or current level if fount) as a list and True or
-        False if search was in allowed
+    def fresh(self, msg_id, options):
+        """Whether msg_id was written with options and its files exist"""
 
-    """
-    if type(msg) is not list:
-        if negation:
-            criteria = msg[search] not in allowed
-        else:
-            criteria = msg[search] in allowed
+        with self.lock:
+            entry = self.messages.get(msg_id)
 
-        if criteria:
-            return [msg], True
-        else:
-            parts = msg[what]
-    else:
-        for m in msg:
-            if negation:
-                criteria = m[search] not in allowed
+        return entry is not None and entry['options'] == options and \
+            all(os.path.exists(os.path.join(self.outdir, fname))
+                for fname in entry['files'])
+
+    def missing(self, msg_ids, options):
+        """msg_ids that still need to be downloaded and written"""
+
+        return [msg_id for msg_id in msg_ids if not self.fresh(msg_id, options)]
+
+    def folder(self, thr_id):
+        """Existing folder of thread thr_id (None if there is none)"""
+
+        with self.lock:
+            folder = self.threads.get(thr_id)
+
+        if folder is None:
+            return None
+
+        folder = os.path.join(self.outdir, folder)
+        return folder if os.path.isdir(folder) else None
+
+    def record(self, msg_id, thr_id, folder, files, digest, options):
+        """Record message msg_id, written to files in folder
+
+        Files an earlier version of the message was written to, and
+        that it no longer is, are removed.
+
+        Returns:
+            False if the same content is already in files (so they need
+            not be written again)
+        """
+
+        entry = {'files':   [os.path.relpath(fname, self.outdir)
+                             for fname in files],
+                 'hash':    digest,
+                 'options': options}
+        with self.lock:
+            self.threads[thr_id] = os.path.relpath(folder, self.outdir)
+            last = self.messages.get(msg_id)
+            self.messages[msg_id] = entry
+            self.changed_messages.add(msg_id)
+            self.changed_threads.add(thr_id)
+
+        if last is None:
+            return True
+
+        for fname in set(last['files']) - set(entry['files']):
+            try:
+                os.remove(os.path.join(self.outdir, fname))
+            except OSError:
+                pass
+
+        return last['hash'] != digest or last['files'] != entry['files'] or \
+            not all(os.path.exists(fname) for fname in files)
+
+    def files(self, msg_id):
+        """Output files of msg_id, relative to the output root"""
+
+        with self.lock:
+            entry = self.messages.get(msg_id)
+
+        return [] if entry is None else list(entry['files'])
+
+    def move(self, moved):
+        """Update the paths of folders that were moved (old -> new)"""
+
+        relpath = lambda fname: os.path.relpath(fname, self.outdir)
+        moved   = dict((relpath(old) + os.sep, relpath(new) + os.sep)
+                       for old, new in moved.items())
+
+        def rename(fname):
+            for old, new in moved.items():
+                if (fname + os.sep).startswith(old):
+                    return (new + (fname + os.sep)[len(old):])[:-1]
+
+            return fname
+
+        with self.lock:
+            for thr_id, folder in self.threads.items():
+                if rename(folder) != folder:
+                    self.threads[thr_id] = rename(folder)
+                    self.changed_threads.add(thr_id)
+
+            for msg_id, entry in self.messages.items():
+                files = [rename(fname) for fname in entry['files']]
+                if files != entry['files']:
+                    entry['files'] = files
+                    self.changed_messages.add(msg_id)
+
+    def save(self, compact = False):
+        """Save the changes since the last save; pick up everyone else's
+
+        Under the lock file the journal lines appended since the last
+        save are applied, then this object's changed entries (which
+        win) are appended as one line. With no changes the journal is
+        only read.
+
+        Kwargs:
+            compact: Fold the journal into the manifest and thread index
+                now (at the end of a run) if it holds any entries
+        """
+
+        with self.lock:
+            mkdir_recursive(self.outdir)
+            with file_lock(self.lockfile):
+                entry = {'messages': dict((msg_id, self.messages[msg_id])
+                                          for msg_id in self.changed_messages),
+                         'threads':  dict((thr_id, self.threads[thr_id])
+                                          for thr_id in self.changed_threads)}
+                if not self.replay(self.messages, self.threads):
+                    self.messages, self.threads = self.load()
+
+                self.messages.update(entry['messages'])
+                self.threads.update(entry['threads'])
+                if entry['messages'] or entry['threads']:
+                    self.append(entry)
+
+                if (compact and self.pending) or \
+                        self.offset > self.compact_min + \
+                        sum(os.path.getsize(fname) for fname in
+                            [self.fname, self.index] if os.path.exists(fname)):
+                    self.compact()
+
+            self.changed_messages = set()
+            self.changed_threads  = set()
+
+    def append(self, entry):
+        """Append entry to the journal (under the lock file)"""
+
+        with open(self.journal, 'a+b') as fout:
+            fout.seek(0, os.SEEK_END)
+            if fout.tell() == 0:
+                fout.write(to_bytes(json.dumps({'generation':
+                                                self.generation}) + '\n'))
             else:
-                criteria = m[search] in allowed
+                # End the last line of a save that was cut short
+                fout.seek(-1, os.SEEK_END)
+                if fout.read(1) != b'\n':
+                    fout.write(b'\n')
+
+            fout.write(to_bytes(json.dumps(entry) + '\n'))
+            fout.seek(0, os.SEEK_END)
+            self.offset   = fout.tell()
+            self.pending += 1
 
-            if m[search] in allowed:
-                return msg, True
+    def compact(self):
+        """Fold the journal into the files (under the lock file)
 
-        parts = msg[0][what]
+        The files are replaced first, with the next generation; a reader
+        that finds the old journal after them skips it (see replay).
+        """
 
-    if type(parts) is not list:
-        parts = [parts]
+        self.generation += 1
+        for fname, data in [(self.index, self.threads),
+                            (self.fname, {'messages':   self.messages,
+                                          'generation': self.generation})]:
+            with open(fname + '.tmp', 'w') as fout:
+                json.dump(data, fout)
 
-    return parts, False
+            os.rename(fname + '.tmp', fname)
 
-def get_key_set(dictionary, keys, fallback = None):
-    """Get first dictionary element in keys
+        with open(self.journal + '.tmp', 'wb') as fout:
+            fout.write(to_bytes(json.dumps({'generation':
+                                            self.generation}) + '\n'))
+            self.offset  = fout.tell()
+            self.pending = 0
 
-    Args:
-        dictionary: dictionary
-        keys: keys to look for
+        os.rename(self.journal + '.tmp', self.journal)
 
-    Returns:
-        First key from keys found, pass, or fallback
+class parquet_export():
+
+    """Metadata of the messages written, appended to a Parquet dataset
+
+    Rows are buffered during a run and flushed as a new file in the
+    dataset folder, part-<time>[-<account>]-<random>.parquet, so the
+    folder grows by a file per run and reads as one table:
+
+    >>> pd.read_parquet(dataset, columns = ['date', 'from'])
+
+    A message written again (changed content or output options) gets
+    another row; keep the last one per id.
     """
 
-    for key in keys:
+    columns  = ['id',
+                'threadId',
+                'account',
+                'from',
+                'to',
+                'cc',
+                'subject',
+                'date',
+                'date_utc',
+                'content_type',
+                'attachment_names',
+                'attachment_sizes',
+                'attachments_saved',
+                'sort_key',
+                'path']
+    max_rows = 100000
+
+    def __init__(self, dataset, account = None):
+        """Append message metadata to the Parquet dataset in folder dataset
+
+        Kwargs:
+            account: Account name, stored in each row and the file names
+        """
+
         try:
-            return dictionary[key]
-        except:
-            pass
+            importlib.import_module('pyarrow')
+        except ImportError:
+            raise Warning("Parquet export needs pyarrow (pip install pyarrow)")
 
-    if fallback is None:
-        pass
-    else:
-        return fallback
+        self.dataset = dataset
+        self.account = account
+        self.rows    = []
+        self.since   = None
+        self.lock    = threading.Lock()
 
-def print_df_query(df, outdir, tzstr, otype, ext):
-    """Print all messages from df into outdir
+    def add(self, df, manifest, keys = []):
+        """Buffer a row for each message in df
 
-    Args:
-        df: df with e-mail
-        outdir: output directory
+        Args:
+            df: Data frame with the messages written (see messages_df)
+            manifest: output_manifest the messages were recorded in;
+                paths (relative to the output root) are taken from it,
+                so call this after sorting
 
-    Returns:
-        Prints to outdir
+        Kwargs:
+            keys: Sort folder names (the sort rules' keys and unsorted)
+        """
 
-    """
+        suffix = ' [ATTACHMENT T0O LARGE]'
+        rows   = []
+        for msg_id, dfmsg in df.iterrows():
+            files = manifest.files(msg_id)
+            fpath = files[0] if files else ''
+            parts = fpath.split(os.sep)
+            fns   = list(dfmsg['fn'])
+            date  = dfmsg['date']
+            utc   = datetime.datetime.utcfromtimestamp(dfmsg['stamp'] / 1000)
+            rows += [[msg_id,
+                      dfmsg['threadId'],
+                      self.account,
+                      dfmsg['from'],
+                      dfmsg['to'],
+                      dfmsg['cc'],
+                      dfmsg['subject'],
+                      date.replace(tzinfo = None),
+                      utc,
+                      dfmsg['ctype'],
+                      [fn[:-len(suffix)] if fn.endswith(suffix) else fn
+                       for fn in fns],
+                      [int(size) for size in dfmsg['att_size']],
+                      [not fn.endswith(suffix) for fn in fns],
+                      parts[1] if len(parts) > 2 and parts[1] in keys else '',
+                      fpath]]
+
+        with self.lock:
+            self.since  = self.since if self.rows else time.time()
+            self.rows  += rows
+
+    def flush(self, age = 0, metrics = None):
+        """Write the buffered rows as a new file of the dataset
 
-    mkdir_recursive(outdir)
-    for thr in df['threadId'].unique():
-        dfmsg = df.ix[df['threadId'] == thr]
+        Kwargs:
+            age: Only write once the oldest buffered row is this many
+                seconds old (or max_rows rows are buffered)
+            metrics: run_metrics object to count the rows written
 
-        outdt     = dfmsg['date'][-1].strftime("%Y-%m-%d %H:%M " + tzstr)
-        outsub    = dfmsg['subject'][-1][:32].replace('/', '|')
-        outfolder = os.path.join(outdir, outdt + ' - ' + outsub)
-        outpath   = filter(lambda x: x in string.printable, outfolder)
+        Returns:
+            File name written (None if nothing was)
+        """
 
-        mkdir_recursive(outpath)
-        try:
-            for i in dfmsg.index:
-                print_df_msg(dfmsg.ix[i], outpath, tzstr, otype, ext)
-        except:
-            print_df_msg(dfmsg, outpath, tzstr, otype, ext)
+        with self.lock:
+            if not self.rows or (time.time() - self.since < age and
+                                 len(self.rows) < self.max_rows):
+                return None
 
-def print_df_msg(dfmsg, dest, tzstr, otype, ext):
-    """Print message out to file
+            rows, self.rows = self.rows, []
 
-    Args:
-        p: Headers and body to print
-        fout: Output folder
+        df = pd.DataFrame(rows, columns = self.columns)
+        df['date']     = pd.to_datetime(df['date'])
+        df['date_utc'] = pd.to_datetime(df['date_utc'], utc = True)
 
-    Kwargs:
-        pretty: Whether to make the body pretty using BS
+        account = '' if self.account is None else '-' + self.account
+        fname   = 'part-%s%s-%08x.parquet' % (time.strftime('%Y%m%dT%H%M%S'),
+                                              account, random.getrandbits(32))
+        mkdir_recursive(self.dataset)
+        tmp = os.path.join(self.dataset, '.' + fname + '.tmp')
+        df.to_parquet(tmp, engine = 'pyarrow', index = False)
+        os.rename(tmp, os.path.join(self.dataset, fname))
+        if metrics is not None:
+            metrics.count('parquet_rows', len(rows))
 
-    Returns:
-        Prints p to file in fout
+        return os.path.join(self.dataset, fname)
+
+class thread_claims():
+
+    """Thread ids claimed by concurrent day shards, each by the first"""
+
+    def __init__(self):
+        self.ids  = set()
+        self.lock = threading.Lock()
+
+    def claim(self, thr_ids):
+        """The thr_ids no other shard has claimed, now claimed"""
+
+        with self.lock:
+            new_ids = [thr_id for thr_id in set(thr_ids)
+                       if thr_id not in self.ids]
+            self.ids.update(new_ids)
+
+        return new_ids
+
+class work_queue():
+
+    """Durable queue of tasks in a shared folder, claimed with leases
+
+    Each task is a JSON file that moves between these sub-folders:
+
+        pending/  waiting for a worker
+        leased/   claimed by a worker; the lease runs out `lease`
+                  seconds after the file's modification time
+        done/     finished
+        failed/   failed `attempts` times (see fail)
+
+    Moves are renames, which are atomic, so only one worker gets each
+    task, also across hosts that share the folder. Workers renew their
+    leases while they work; a task whose lease ran out (its worker died
+    or hung) is moved back to pending by the next worker that looks.
+    Hosts' clocks must agree to well within the lease.
     """
 
-    dstr = "%Y-%m-%d %H:%M " + tzstr
-    try:
-        h  = dfmsg['header'].values[0]
-        fh = dfmsg['ft_header'].values[0]
-        b  = dfmsg['body'].values[0]
-        f  = pd.to_datetime(dfmsg['date'].values).strftime(dstr)[0]
-        fn = dfmsg['fn'].values
-        a  = dfmsg['att'].values
-    except:
-        h  = dfmsg['header']
-        fh = dfmsg['ft_header']
-        b  = dfmsg['body']
-        fn = dfmsg['fn']
-        a  = dfmsg['att']
+    states = ['pending', 'leased', 'done', 'failed']
+
+    def __init__(self, folder, lease = 600):
+        """Queue in folder
+
+        Kwargs:
+            lease: Seconds a claimed task stays with its worker without
+                being renewed
+        """
+
+        self.folder = folder
+        self.lease  = lease
+        for state in self.states:
+            mkdir_recursive(os.path.join(folder, state))
+
+    def path(self, state, name):
+        return os.path.join(self.folder, state, name)
+
+    def tasks(self, state):
+        return sorted(fname for fname in os.listdir(os.path.join(self.folder,
+                                                                 state))
+                      if fname.endswith('.json'))
+
+    def counts(self):
+        return dict((state, len(self.tasks(state))) for state in self.states)
+
+    def put(self, name, task, state = 'pending'):
+        """Add task (a dictionary) as task name (file name.json)"""
+
+        fname = self.path(state, name if name.endswith('.json')
+                          else name + '.json')
+        with open(fname + '.tmp', 'w') as fout:
+            json.dump(task, fout)
+
+        os.rename(fname + '.tmp', fname)
+
+    def claim(self):
+        """Lease the next pending task
+
+        Returns:
+            (name, task), or None if no task is pending
+        """
+
+        self.reclaim()
+        names = self.tasks('pending')
+        random.shuffle(names)  # Workers rarely race for the same task
+        for name in names:
+            try:
+                # Touch first so the lease is fresh the moment it is held
+                os.utime(self.path('pending', name), None)
+                os.rename(self.path('pending', name), self.path('leased', name))
+            except OSError:
+                continue  # Another worker got it
+
+            try:
+                return name, json.load(open(self.path('leased', name)))
+            except (IOError, ValueError):
+                self.release(name)
+
+        return None
+
+    def renew(self, name):
+        """Extend the lease on task name; False if it was lost"""
+
         try:
-            f = dfmsg['date'].strftime(dstr)
-        except:
-            f = dfmsg['date'][0].strftime(dstr)
+            os.utime(self.path('leased', name), None)
+            return True
+        except OSError:
+            return False
 
-    try:
-        h  = unicode(h).encode('utf-8')
-        fh = unicode(fh).encode('utf-8')
-        b  = unicode(b).encode('utf-8')
-    except:
-        pass
+    def done(self, name):
+        """Mark leased task name finished; False if the lease was lost"""
 
-    if otype != 'eml':
-        with open(os.path.join(dest, f + ext), "wb") as fout:
-            print(fh + os.linesep + os.linesep, file = fout)
-            print(b, file = fout)
-
-        if fn is not None:
-            with open(os.path.join(dest, fn), "wb") as fout:
-                if fn.endswith(' [ATTACHMENT T0O LARGE]'):
-                    fout.write(a)
-                else:
-                    fout.write(base64.urlsafe_b64decode(a))
+        try:
+            os.rename(self.path('leased', name), self.path('done', name))
+            return True
+        except OSError:
+            return False
 
-    if otype == 'eml' and fn is not None:
-        msg_sep = '-q1w2e3r4t5'
-        msg_c   = 'Content-type: multipart/mixed; boundary="%s"' % msg_sep
-        hlist   = h.split(os.linesep)
-        header  = os.linesep.join(hlist[:-1] + [msg_c])
+    def fail(self, name, task, error, attempts = 3):
+        """Give up leased task name after a failure
 
-        msg_h   = hlist[-1] + os.linesep + 'Content-Disposition: inline'
-        att_h   = [u'Content-Type: application; name="%s"' % fn]
-        att_h  += [u'Content-Transfer-Encoding: base64']
-        att_h  += [u'Content-Disposition: attachment; filename="%s"' % fn]
-        att_h   = os.linesep.join(att_h)
+        It goes back to pending for another try, or to failed/ once it
+        has failed attempts times. The error is kept in the task.
+        """
+
+        task  = dict(task, attempts = task.get('attempts', 0) + 1,
+                     error = error)
+        state = 'pending' if task['attempts'] < attempts else 'failed'
+        self.put(name, task, state)
+        try:
+            os.remove(self.path('leased', name))
+        except OSError:
+            pass
 
-        with open(os.path.join(dest, f + ext), "wb") as fout:
-            print(header + os.linesep, file = fout)
+    def release(self, name):
+        """Put leased task name back in pending, as it was"""
 
-            print('--' + msg_sep, file = fout)
-            print(msg_h + os.linesep, file = fout)
-            print(b + os.linesep, file = fout)
+        try:
+            os.rename(self.path('leased', name), self.path('pending', name))
+        except OSError:
+            pass
 
-            print('--' + msg_sep, file = fout)
-            print(unicode(att_h).encode('utf-8') + os.linesep, file = fout)
-            att_wrap = hard_wrap(a.replace('-', '+').replace('_', '/'), 76)
-            print(att_wrap + os.linesep, file = fout)
+    def reclaim(self):
+        """Move leased tasks whose lease ran out back to pending"""
 
-            print('--' + msg_sep + '--', file = fout)
-    elif otype == 'eml':
-        with open(os.path.join(dest, f + ext), "wb") as fout:
-            print(h + os.linesep, file = fout)
-            print(b, file = fout)
+        for name in self.tasks('leased'):
+            try:
+                if time.time() - os.path.getmtime(self.path('leased', name)) \
+                        > self.lease:
+                    self.release(name)
+            except OSError:
+                pass  # Finished or reclaimed in the meantime
+
+    @contextmanager
+    def held(self, name):
+        """Renew the lease on task name while the enclosed block runs"""
+
+        stop = threading.Event()
+        def renew():
+            while not stop.wait(self.lease / 4):
+                self.renew(name)
+
+        renewer = threading.Thread(target = renew)
+        renewer.daemon = True
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
 
-def hard_wrap(text, width):
-    nl  = int(len(text) / width)
-    l   = 0
-    hw  = [text[l * width:(l + 1) * width]]
-    while l < nl:
-        l  += 1
-        hw += [text[l * width:(l + 1) * width]]
+def render_options(otype, ext, msize, first, budget = None,
+                   renderer = 'pandoc', raw_max = None):
+    """Options that change a message's output, as stored in the manifest
 
-    return os.linesep.join(hw)
+    The renderer is only recorded when it is native, so manifests written
+    by pandoc runs stay current.
+    """
 
-def apply_rules(srules, outdir, indir, infile, case):
+    options = {'otype':   otype,
+               'ext':     ext,
+               'att_max': None if msize is None else int(msize.bytes),
+               'first':   bool(first),
+               'raw_max': raw_max,
+               'strip':   strip_version,
+               'dates':   'internal'}
+    if budget is not None and msize is not None and \
+            budget.limits() != [None, None]:
+        options['att_budget'] = budget.limits()
+    if native_render(renderer, otype):
+        options['renderer'] = 'native'
+
+    return options
+
+def message_digest(dfmsg):
+    """sha1 of the parsed message (header, body and attachments)"""
+
+    digest = hashlib.sha1()
+    parts  = [dfmsg['header'], dfmsg['ft_header'], dfmsg['body'],
+              dfmsg['date'].isoformat()]
+    for part in parts + list(dfmsg['fn']) + list(dfmsg['att']):
+        digest.update(to_bytes(part))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+def apply_rules(srules, outdir, indir, infile, case, shard = ''):
     """Recursively applies rules in srules within outdir
 
     Args:
@@ -1099,6 +4657,9 @@ def apply_rules(srules, outdir, indir, infile, case):
         infile: Input file to apply the rules to.
         case: Whether regex is case-sensitive
 
+    Kwargs:
+        shard: Move indir to outdir/key/shard instead of outdir/key
+
     Returns:
         Each key in srules is a sub-folder within outdir where indir
         will be moved to if it infile matches the corresponding rule.
@@ -1108,7 +4669,8 @@ def apply_rules(srules, outdir, indir, infile, case):
 
     flat = [[k, v["priority"], v["rules"]] for k, v in srules.items()]
     for key, priority, rules in sorted(flat, key = itemgetter(1)):
-        for i, line in enumerate(open(os.path.join(indir, infile))):
+        fname = os.path.join(indir, infile)
+        for i, line in enumerate(io.open(fname, errors = 'replace')):
             for rule in rules:
                 if case:
                     search = re.search(rule, line)
@@ -1116,8 +4678,8 @@ def apply_rules(srules, outdir, indir, infile, case):
                     search = re.search(rule, line, re.IGNORECASE)
 
                 if search:
-                    mkdir_recursive(os.path.join(outdir, key))
-                    move(indir, os.path.join(outdir, key))
+                    mkdir_recursive(os.path.join(outdir, key, shard))
+                    move(indir, os.path.join(outdir, key, shard))
                     return key
 
     return None
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Query e-mail from gmail within an asyncio event loop
+
+Async variant of the gmail_query pipeline for services that already run
+an event loop. Message listing pages through the Gmail REST API with
+aiohttp, message and attachment gets run concurrently (bounded by a
+semaphore and the same quota-units-per-second budget as gmail_query),
+and body conversion (pandoc or the native renderer) and file output are
+offloaded to an executor so they never block the loop.
+
+Python 3 only; requires aiohttp on top of the gmail_query dependencies.
+
+Usage
+-----
+
+>>> import asyncio
+>>> from gmail_query_async import async_gmail_query
+>>> async def run():
+...     query = await async_gmail_query.create('/path/to/output')
+...     try:
+...         await query.query(todays = '2016-06-01', bdays = 7)
+...         df = await query.query_todays('2016-06-01', 0, False, 'html')
+...     finally:
+...         await query.close()
+>>> asyncio.run(run())
+"""
+
+from bitmath import parse_string
+import gmail_query as gq
+import functools
+import datetime
+import asyncio
+import aiohttp
+import httplib2
+import random
+import time
+import os
+
+api_root = 'https://www.googleapis.com/'
+
+class async_gmail_query():
+
+    """Query gmail e-mail from an asyncio event loop
+
+    Wraps a gmail_query object, which holds the credentials, the
+    configuration defaults and the (synchronous) parsing and output
+    functions. Create with `await async_gmail_query.create(outdir)` so
+    the blocking credential load happens in an executor.
+    """
+
+    def __init__(self, query, concurrency = 100, executor = None):
+        """Query gmail e-mail from an asyncio event loop
+
+        Args:
+            query: gmail_query object
+
+        Kwargs:
+            concurrency: Maximum API requests in flight
+            executor: Executor for conversion and output (default is
+                the loop's default executor)
+        """
+
+        self.gmail    = query
+        self.cfg_args = query.cfg_args
+        self.executor = executor
+        self.requests = asyncio.Semaphore(concurrency)
+        self.budget   = async_budget(query.cfg_args.quota_rate)
+        self.session  = aiohttp.ClientSession()
+        self.root     = (query.api_root or api_root).rstrip('/') + \
+            '/gmail/v1/users/me/'
+
+    @classmethod
+    async def create(cls, outdir, cfgfile = gq.cfgfile, **kwargs):
+        """Create the underlying gmail_query object in an executor"""
+
+        loop  = asyncio.get_running_loop()
+        query = await loop.run_in_executor(None, functools.partial(
+            gq.gmail_query, outdir, cfgfile = cfgfile))
+        return cls(query, **kwargs)
+
+    async def close(self):
+        await self.session.close()
+
+    async def run(self, fun, *args):
+        """Run blocking fun(*args) in the executor"""
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(fun, *args))
+
+    async def query(self,
+                    todays  = None,
+                    bdays   = None,
+                    otype   = None,
+                    ext     = None,
+                    att_get = None,
+                    att_max = None,
+                    mail    = None,
+                    first   = None,
+                    sort_case  = None,
+                    sort_rules = None):
+
+        """Query Gmail e-mail for specified date
+
+        Same arguments and output layout as gmail_query.query.
+
+        Returns:
+            df: Data frame with the messages written (None if none)
+        """
+
+        cfg = self.cfg_args
+        bdays   = cfg.bdays   if bdays   is None else bdays
+        otype   = cfg.otype   if otype   is None else otype
+        ext     = cfg.ext     if ext     is None else ext
+        att_get = cfg.att_get if att_get is None else att_get
+        att_max = cfg.att_max if att_max is None else att_max
+        mail    = cfg.mail    if mail    is None else mail
+        first   = cfg.first   if first   is None else first
+        sort_case  = cfg.sort_case if sort_case  is None else sort_case
+        sort_rules = cfg.sort_file if sort_rules is None else sort_rules
+
+        ptypes = await self.run(gq.output_types, self.gmail.renderer, otype)
+        if otype not in ptypes and not otype == 'eml':
+            raise Warning("Output type must be: {}".format(', '.join(ptypes)))
+
+        self.gmail.att_budget = gq.att_budget(self.gmail.att_run,
+                                              self.gmail.att_thread)
+
+        max_size = parse_string(att_max) if att_get else None
+        ext      = gq.ext_dict[otype] if ext == '' else ext
+        options  = gq.render_options(otype, ext, max_size, first,
+                                     self.gmail.att_budget,
+                                     self.gmail.renderer,
+                                     self.gmail.raw_max)
+        todays   = todays if todays else str(datetime.date.today())
+        outdir   = os.path.join(self.gmail.outdir, todays)
+
+        try:
+            df = await self.query_todays(todays, bdays, first, otype, max_size,
+                                         options)
+        except Exception:
+            df = None
+
+        if df is not None:
+            await self.run(self.gmail.write_query,
+                           df, outdir, otype, ext, sort_rules, sort_case,
+                           options)
+            res = "Success! See output folder:" + os.linesep + outdir
+        else:
+            res = 'No e-mail %s' % todays
+
+        await self.run(self.gmail.flush_export)
+        await self.run(self.gmail.notify, "Mail Dump for %s" % todays, res, mail)
+        return df
+
+    async def query_todays(self, todays, bdays, first, otype, msize = None,
+                           options = None):
+        """Get all messages from todays and bdays before it
+
+        Messages already written with options are skipped (see
+        gmail_query.query_ids).
+
+        Returns:
+            df: Data frame with the messages, as gmail_query.query_todays
+        """
+
+        query   = gq.todays_query(todays, bdays)
+        msg_ids = list(set(await self.list_ids(query)))
+        if options is not None:
+            msg_ids = await self.run(self.gmail.manifest.missing,
+                                     msg_ids, options)
+
+        if not msg_ids:
+            return None
+
+        msgs    = await asyncio.gather(*[self.get_msg(mid) for mid in msg_ids])
+        indexes = [gq.index_parts(msg['payload']) for msg in msgs]
+        dates   = gq.local_dates([msg.get('internalDate') for msg in msgs],
+                                 self.gmail.timezone)
+        parsed  = asyncio.gather(*[
+            self.run(functools.partial(self.gmail.parse_msg, index = index,
+                                       date = date),
+                     msg, otype)
+            for msg, index, date in zip(msgs, indexes, dates)])
+
+        # Attachments download while bodies convert in the executor
+        atts    = await self.fetch_atts(msgs, indexes, msize)
+        pmsgs   = await parsed
+        thr_ids = [msg['threadId'] for msg in msgs]
+        return gq.messages_df(msg_ids, thr_ids, pmsgs, atts, first)
+
+    async def fetch_atts(self, msgs, indexes, msize):
+        """Get attachments within the budget (see gmail_query.fetch_atts)"""
+
+        if msize is None:
+            return [[[], [], []] for msg in msgs]
+
+        jobs, notes = self.gmail.att_budget.plan(msgs, indexes, msize)
+        data = await asyncio.gather(*[
+            self.get_att(msgs[i]['id'],
+                         indexes[i]['attachments'][j]['attachmentId'])
+            for size, i, j in jobs])
+
+        fetched = dict(((i, j), d['data'])
+                       for (size, i, j), d in zip(jobs, data))
+        return gq.collect_atts(indexes, notes, fetched)
+
+    async def list_ids(self, query):
+        """List all message ids matching query, following every page"""
+
+        msg_ids = []
+        params  = {'q': query, 'maxResults': 500}
+        while True:
+            res = await self.get('messages', params,
+                                 gq.quota_units['messages.list'])
+            msg_ids += [ids['id'] for ids in res.get('messages', [])]
+            if 'nextPageToken' not in res:
+                return msg_ids
+
+            params['pageToken'] = res['nextPageToken']
+
+    async def get_msg(self, msg_id):
+        return await self.get('messages/' + msg_id,
+                              {'format': 'full', 'fields': gq.msg_fields},
+                              gq.quota_units['messages.get'])
+
+    async def get_att(self, msg_id, att_id):
+        return await self.get('messages/%s/attachments/%s' % (msg_id, att_id),
+                              {}, gq.quota_units['messages.attachments.get'])
+
+    async def token(self, refresh = False):
+        """OAuth access token, refreshed in the executor when expired"""
+
+        credentials = self.gmail.credentials
+        if credentials is None:
+            return None
+        elif refresh or credentials.access_token_expired:
+            await self.run(credentials.refresh, httplib2.Http())
+
+        return credentials.access_token
+
+    async def get(self, endpoint, params, units, retries = 5):
+        """GET endpoint (under users/me) within the request budget
+
+        Rate-limited and failed requests are retried with exponential
+        backoff; an expired token is refreshed once.
+        """
+
+        for attempt in range(retries + 1):
+            await self.budget.acquire(units)
+            async with self.requests:
+                token   = await self.token()
+                headers = {'Authorization': 'Bearer ' + token} if token else {}
+                async with self.session.get(self.root + endpoint,
+                                            params  = params,
+                                            headers = headers) as resp:
+                    if resp.status == 401 and attempt == 0:
+                        await self.token(refresh = True)
+                        continue
+                    elif resp.status not in [429, 500, 503] or attempt == retries:
+                        resp.raise_for_status()
+                        return await resp.json()
+
+            await asyncio.sleep(2 ** attempt + random.random())
+
+class async_budget():
+
+    """Quota units per second shared by every request on the loop"""
+
+    def __init__(self, rate = 250):
+        self.rate   = rate
+        self.tokens = rate
+        self.stamp  = time.monotonic()
+        self.lock   = asyncio.Lock()
+
+    async def acquire(self, units):
+        """Wait until units are available, then spend them"""
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.rate,
+                                  self.tokens + (now - self.stamp) * self.rate)
+                self.stamp  = now
+                if self.tokens >= units:
+                    self.tokens -= units
+                    return
+
+                await asyncio.sleep((units - self.tokens) / self.rate)